@@ -16,6 +16,8 @@ from qgis.core import *
 from qgis.gui import *
 
 from nodetool import NodeTool
+from instrumentation import LatencyDockWidget
+from vertextable import VertexTableDockWidget
 
 def classFactory(iface):
     return CadNodeToolPlugin(iface)
@@ -25,6 +27,10 @@ class CadNodeToolPlugin:
     def __init__(self, iface):
         self.iface = iface
         self.current_layer = None
+        self.selection_message = None   # message bar item with progress of selection of nodes
+        self.selection_progress_bar = None
+        self.locator_message = None     # message bar item with progress of indexing of layers
+        self.locator_progress_bar = None
 
     def initGui(self):
         self.action = QAction("NODE", self.iface.mainWindow())
@@ -36,12 +42,39 @@ class CadNodeToolPlugin:
 
         self.tool = NodeTool(self.iface.mapCanvas(), self.iface.cadDockWidget())
         self.tool.setAction(self.action)
+        self.tool.selection_progress.connect(self.onSelectionProgress)
+        self.tool.selection_finished.connect(self.onSelectionFinished)
+        self.tool.locator_warmup.progress.connect(self.onLocatorProgress)
+        self.tool.locator_warmup.finished.connect(self.onLocatorFinished)
+
+        # latencies of the tool (only recorded when enabled in the dock)
+        self.latency_dock = LatencyDockWidget(self.tool.latency, self.iface.mainWindow())
+        self.iface.addDockWidget(Qt.RightDockWidgetArea, self.latency_dock)
+        self.latency_dock.hide()
+        self.latency_action = self.latency_dock.toggleViewAction()
+        self.iface.addPluginToMenu("CAD Node Tool", self.latency_action)
+
+        # coordinates of vertices of the feature with selected nodes
+        self.vertex_dock = VertexTableDockWidget(self.tool, self.iface.mainWindow())
+        self.iface.addDockWidget(Qt.RightDockWidgetArea, self.vertex_dock)
+        self.vertex_dock.hide()
+        self.vertex_action = self.vertex_dock.toggleViewAction()
+        self.iface.addPluginToMenu("CAD Node Tool", self.vertex_action)
 
         self.onCurrentLayerChanged()
 
     def unload(self):
         self.iface.removeToolBarIcon(self.action)
+        self.iface.removePluginMenu("CAD Node Tool", self.latency_action)
+        self.iface.removePluginMenu("CAD Node Tool", self.vertex_action)
+        self.iface.removeDockWidget(self.latency_dock)
+        self.iface.removeDockWidget(self.vertex_dock)
+        self.vertex_dock.model.set_feature(None, None)   # disconnect from the layer
         self.iface.mapCanvas().unsetMapTool(self.tool)
+        del self.latency_action
+        del self.latency_dock
+        del self.vertex_action
+        del self.vertex_dock
         del self.action
         del self.tool
 
@@ -60,3 +93,35 @@ class CadNodeToolPlugin:
 
     def onEditingStartStop(self):
         self.action.setEnabled(self.tool.can_use_current_layer())
+        if self.current_layer.isEditable():
+            self.tool.start_locator_warmup()   # the layer will be needed for snapping soon
+
+    def onSelectionProgress(self, percent):
+        if self.selection_message is None:
+            self.selection_progress_bar = QProgressBar()
+            self.selection_progress_bar.setMaximum(100)
+            self.selection_message = self.iface.messageBar().createMessage("Selecting nodes (Esc to cancel)...")
+            self.selection_message.layout().addWidget(self.selection_progress_bar)
+            self.iface.messageBar().pushWidget(self.selection_message, QgsMessageBar.INFO)
+        self.selection_progress_bar.setValue(percent)
+
+    def onSelectionFinished(self):
+        if self.selection_message is not None:
+            self.iface.messageBar().popWidget(self.selection_message)
+            self.selection_message = None
+            self.selection_progress_bar = None
+
+    def onLocatorProgress(self, done, total):
+        if self.locator_message is None:
+            self.locator_progress_bar = QProgressBar()
+            self.locator_message = self.iface.messageBar().createMessage("Indexing layers for snapping...")
+            self.locator_message.layout().addWidget(self.locator_progress_bar)
+            self.iface.messageBar().pushWidget(self.locator_message, QgsMessageBar.INFO)
+        self.locator_progress_bar.setMaximum(total)
+        self.locator_progress_bar.setValue(done)
+
+    def onLocatorFinished(self):
+        if self.locator_message is not None:
+            self.iface.messageBar().popWidget(self.locator_message)
+            self.locator_message = None
+            self.locator_progress_bar = None
@@ -0,0 +1,352 @@
+#-----------------------------------------------------------
+# Copyright (C) 2015 Martin Dobias
+#-----------------------------------------------------------
+# Licensed under the terms of GNU GPL 2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#---------------------------------------------------------------------
+
+"""
+Benchmarks of the hot paths of the node tool on synthetic memory layers:
+hover, drag start, drop, rect selection, deletion of vertices and memory used by the cache.
+Results are written as JSON so they can be compared between releases.
+
+Runs headless - with Qt4 builds of QGIS use a virtual X server:
+
+    xvfb-run python benchmarks/benchmark_nodetool.py --scale 1 --output results.json
+
+(with Qt5 builds the "offscreen" platform plugin is used automatically).
+
+With --check-budgets the feature requests are accounted in strict mode: the first interaction
+that sends more requests than its budget (see requeststats.REQUEST_BUDGETS) stops the run with
+an error. Hovering again over the same place (and dragging a hovered vertex without topological
+editing) is also checked to send no requests at all.
+"""
+
+import argparse
+import json
+import math
+import os
+import platform
+import sys
+import time
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from PyQt4.QtGui import *
+from PyQt4.QtCore import *
+
+from qgis.core import *
+from qgis.gui import *
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from nodetool import NodeTool
+from geomutils import vertex_coordinates
+from requeststats import HOVER, DRAG_START, DROP, DELETE, RECT_SELECT, TEMP_LOCATOR
+
+
+CANVAS_WIDTH, CANVAS_HEIGHT = 800, 600
+VIEW_WIDTH, VIEW_HEIGHT = 80., 60.   # map units shown in the canvas -> 10 pixels per map unit
+
+
+# ------------
+# synthetic datasets - each function returns tuple (layer type, list of geometries, view center, topological editing)
+
+def long_linestrings(scale):
+    """ a few lines with a lot of vertices each """
+    vertex_count = int(20000 * scale)
+    geoms = []
+    for i in xrange(5):
+        points = [QgsPoint(j, i * 10 + 2 * math.sin(j / 5.)) for j in xrange(vertex_count)]
+        geoms.append(QgsGeometry.fromPolyline(points))
+    return "LineString", geoms, QgsPoint(vertex_count / 2, 20), False
+
+
+def many_part_multipolygons(scale):
+    """ features made of many small square parts """
+    geoms = []
+    for i in xrange(int(200 * scale)):
+        x0, y0 = (i % 20) * 12, (i / 20) * 7
+        parts = []
+        for j in xrange(50):
+            x, y = x0 + (j % 10), y0 + (j / 10)
+            parts.append([[QgsPoint(x, y), QgsPoint(x + .5, y), QgsPoint(x + .5, y + .5), QgsPoint(x, y + .5), QgsPoint(x, y)]])
+        geoms.append(QgsGeometry.fromMultiPolygon(parts))
+    return "MultiPolygon", geoms, QgsPoint(VIEW_WIDTH / 2, VIEW_HEIGHT / 2), False
+
+
+def shared_node_network(scale):
+    """ grid of horizontal and vertical lines sharing nodes at every crossing """
+    size = int(200 * math.sqrt(scale))
+    geoms = []
+    for i in xrange(size):
+        geoms.append(QgsGeometry.fromPolyline([QgsPoint(j, i) for j in xrange(size)]))
+        geoms.append(QgsGeometry.fromPolyline([QgsPoint(i, j) for j in xrange(size)]))
+    return "LineString", geoms, QgsPoint(size / 2, size / 2), True
+
+
+def curved_geometries(scale):
+    """ compound curves made of circular arcs """
+    geoms = []
+    for i in xrange(int(1000 * scale)):
+        x0, y0 = (i % 20) * 45, (i / 20) * 2
+        coords = []
+        for j in xrange(41):
+            coords.append("%f %f" % (x0 + j, y0 + (.5 if j % 2 else 0)))
+        geoms.append(QgsGeometry.fromWkt("COMPOUNDCURVE(CIRCULARSTRING(%s))" % ", ".join(coords)))
+    return "CompoundCurve", geoms, QgsPoint(VIEW_WIDTH / 2, VIEW_HEIGHT / 2), False
+
+
+DATASETS = [
+    ("long_linestrings", long_linestrings),
+    ("many_part_multipolygons", many_part_multipolygons),
+    ("shared_node_network", shared_node_network),
+    ("curved_geometries", curved_geometries),
+]
+
+
+def create_layer(name, layer_type, geoms):
+    layer = QgsVectorLayer("%s?crs=EPSG:3857" % layer_type, name, "memory")
+    features = []
+    for geom in geoms:
+        f = QgsFeature()
+        f.setGeometry(geom)
+        features.append(f)
+    layer.dataProvider().addFeatures(features)
+    layer.updateExtents()
+    return layer
+
+
+# ------------
+# helpers
+
+def summary(durations):
+    """ Return dictionary with statistics of durations (in seconds) - values in milliseconds """
+    if len(durations) == 0:
+        return {"count": 0}
+    d = sorted(durations)
+    return {
+        "count": len(d),
+        "mean_ms": sum(d) / len(d) * 1000,
+        "median_ms": d[len(d) / 2] * 1000,
+        "max_ms": d[-1] * 1000,
+    }
+
+
+def mouse_event(canvas, event_type, pos, button=Qt.NoButton):
+    return QgsMapMouseEvent(canvas, QMouseEvent(event_type, pos, button, button, Qt.NoModifier))
+
+
+def sample_vertices(layer, view_rect, count):
+    """ Return list of up to count QgsPoint of vertices of the layer within the view """
+    inner = QgsRectangle(view_rect)
+    inner.scale(0.8)
+    points = []
+    for f in layer.getFeatures(QgsFeatureRequest(inner).setSubsetOfAttributes([])):
+        xs, ys = vertex_coordinates(f.geometry())
+        for i in xrange(len(xs)):
+            if inner.contains(QgsPoint(xs[i], ys[i])):
+                points.append(QgsPoint(xs[i], ys[i]))
+    step = max(1, len(points) / count)
+    return points[::step][:count]
+
+
+# ------------
+# benchmarks
+
+def bench_hover(tool, canvas, points):
+    durations = []
+    for i, pt in enumerate(points):
+        pos = tool.toCanvasCoordinates(pt)
+        if i % 2:
+            pos += QPoint(4, 3)   # near an edge rather than right at the vertex
+        e = mouse_event(canvas, QEvent.MouseMove, pos)
+        t0 = time.time()
+        with tool.request_stats.interaction(HOVER):
+            tool.mouse_move_not_dragging(e)
+        durations.append(time.time() - t0)
+    return summary(durations)
+
+
+def bench_drag(tool, canvas, points):
+    start_durations, drop_durations = [], []
+    for pt in points:
+        e = mouse_event(canvas, QEvent.MouseButtonRelease, tool.toCanvasCoordinates(pt), Qt.LeftButton)
+        m = tool.snap_to_editable_layer(e)
+        if not m.hasVertex():
+            continue
+
+        t0 = time.time()
+        with tool.request_stats.interaction(DRAG_START):
+            tool.start_dragging_move_vertex(m.point(), m)
+        t1 = time.time()
+        with tool.request_stats.interaction(DROP):
+            tool.move_vertex(QgsPoint(m.point().x() + .1, m.point().y() + .1), QgsPointLocator.Match())
+        t2 = time.time()
+
+        start_durations.append(t1 - t0)
+        drop_durations.append(t2 - t1)
+    return summary(start_durations), summary(drop_durations)
+
+
+def check_cached_interactions(tool, canvas, points, topo):
+    """ Interactions with features that have just been hovered must be served from the cache """
+    for pt in points:
+        e = mouse_event(canvas, QEvent.MouseMove, tool.toCanvasCoordinates(pt))
+        with tool.request_stats.interaction(HOVER):
+            tool.mouse_move_not_dragging(e)
+        total = tool.request_stats.total()
+        with tool.request_stats.interaction(HOVER):
+            tool.mouse_move_not_dragging(e)
+        assert tool.request_stats.total() == total, "hover again sent feature requests"
+
+        m = tool.snap_to_editable_layer(e)
+        if topo or not m.hasVertex():
+            continue
+        with tool.request_stats.interaction(DRAG_START):
+            tool.start_dragging_move_vertex(m.point(), m)
+        with tool.request_stats.interaction(DROP):
+            tool.move_vertex(m.point(), QgsPointLocator.Match())
+        assert tool.request_stats.total() == total, "drag of hovered vertex sent feature requests"
+
+    assert tool.request_stats.total(TEMP_LOCATOR) == 0, "snapping used temporary locators after warm-up"
+
+
+def select_rect(tool, canvas, rect):
+    """ Select nodes within the rect in canvas pixels """
+    tool.dragging_rect_start_pos = rect.topLeft()
+    e = mouse_event(canvas, QEvent.MouseButtonRelease, rect.bottomRight(), Qt.LeftButton)
+    with tool.request_stats.interaction(RECT_SELECT):
+        tool.select_nodes_in_rect(e)
+        tool.wait_for_node_selection()
+    tool.dragging_rect_start_pos = None
+    return len(tool.selected_nodes)
+
+
+def bench_rect_select(tool, canvas, repeat):
+    durations = []
+    node_count = 0
+    for i in xrange(repeat):
+        t0 = time.time()
+        node_count = select_rect(tool, canvas, QRect(0, 0, CANVAS_WIDTH, CANVAS_HEIGHT))
+        durations.append(time.time() - t0)
+    tool.set_highlighted_nodes([])
+    result = summary(durations)
+    result["selected_nodes"] = node_count
+    return result
+
+
+def bench_delete(tool, canvas):
+    # delete nodes of the central part of the view
+    node_count = select_rect(tool, canvas, QRect(CANVAS_WIDTH / 4, CANVAS_HEIGHT / 4, CANVAS_WIDTH / 2, CANVAS_HEIGHT / 2))
+    t0 = time.time()
+    with tool.request_stats.interaction(DELETE):
+        tool.delete_vertex()
+    duration = time.time() - t0
+    return {
+        "deleted_nodes": node_count,
+        "duration_ms": duration * 1000,
+        "nodes_per_second": node_count / duration if duration > 0 else None,
+    }
+
+
+def run_dataset(name, func, scale, samples, check_budgets):
+    layer_type, geoms, center, topo = func(scale)
+    vertex_count = sum(len(vertex_coordinates(geom)[0]) for geom in geoms)
+    layer = create_layer(name, layer_type, geoms)
+    QgsMapLayerRegistry.instance().addMapLayer(layer)
+    QgsProject.instance().writeEntry("Digitizing", "/TopologicalEditing", 1 if topo else 0)
+
+    canvas = QgsMapCanvas()
+    canvas.resize(CANVAS_WIDTH, CANVAS_HEIGHT)
+    canvas.setLayerSet([QgsMapCanvasLayer(layer)])
+    canvas.setCurrentLayer(layer)
+    view_rect = QgsRectangle(center.x() - VIEW_WIDTH / 2, center.y() - VIEW_HEIGHT / 2,
+                             center.x() + VIEW_WIDTH / 2, center.y() + VIEW_HEIGHT / 2)
+    canvas.setExtent(view_rect)
+    canvas.refresh()
+
+    cad_dock = QgsAdvancedDigitizingDockWidget(canvas)
+    tool = NodeTool(canvas, cad_dock)
+    tool.request_stats.strict = check_budgets
+    canvas.setMapTool(tool)
+    layer.startEditing()
+
+    points = sample_vertices(layer, canvas.mapSettings().visibleExtent(), samples)
+
+    t0 = time.time()
+    tool.start_locator_warmup()
+    tool.locator_warmup.finish()
+    index_duration = time.time() - t0
+
+    result = {
+        "features": len(geoms),
+        "vertices": vertex_count,
+        "topological_editing": topo,
+        "locator_index_ms": index_duration * 1000,
+    }
+    if check_budgets:
+        check_cached_interactions(tool, canvas, points[:10], topo)
+    result["hover"] = bench_hover(tool, canvas, points)
+    result["drag_start"], result["drop"] = bench_drag(tool, canvas, points)
+    result["rect_select"] = bench_rect_select(tool, canvas, max(1, samples / 10))
+    result["delete"] = bench_delete(tool, canvas)
+    result["cache"] = tool.cache.stats()
+    result["requests"] = tool.request_stats.counts
+    result["budget_violations"] = tool.request_stats.violations
+
+    canvas.unsetMapTool(tool)
+    layer.rollBack()
+    del tool
+    QgsMapLayerRegistry.instance().removeMapLayer(layer.id())
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks of the CAD node tool")
+    parser.add_argument("--scale", type=float, default=1., help="size factor of synthetic datasets")
+    parser.add_argument("--samples", type=int, default=50, help="number of hover/drag samples per dataset")
+    parser.add_argument("--datasets", nargs="*", default=[name for name, _ in DATASETS], help="datasets to run")
+    parser.add_argument("--output", help="JSON file for results (default: standard output)")
+    parser.add_argument("--check-budgets", action="store_true",
+                        help="stop with error as soon as some interaction sends too many feature requests")
+    args = parser.parse_args()
+
+    app = QgsApplication(sys.argv, True)
+    QgsApplication.initQgis()
+
+    results = {
+        "qgis_version": QGis.QGIS_VERSION,
+        "python_version": platform.python_version(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "scale": args.scale,
+        "samples": args.samples,
+        "datasets": {},
+    }
+    for name, func in DATASETS:
+        if name in args.datasets:
+            print >>sys.stderr, "running", name
+            results["datasets"][name] = run_dataset(name, func, args.scale, args.samples, args.check_budgets)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print output
+
+    QgsApplication.exitQgis()
+
+    violations = sum(len(r["budget_violations"]) for r in results["datasets"].itervalues())
+    if args.check_budgets and violations != 0:
+        print >>sys.stderr, "too many feature requests:", violations
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,219 @@
+#-----------------------------------------------------------
+# Copyright (C) 2015 Martin Dobias
+#-----------------------------------------------------------
+# Licensed under the terms of GNU GPL 2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#---------------------------------------------------------------------
+
+from array import array
+
+from PyQt4.QtGui import *
+from PyQt4.QtCore import *
+
+from qgis.core import *
+from qgis.gui import *
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from geomutils import polygon_from_arrays
+
+
+def _map_to_pixel_affine(map_to_pixel):
+    """ Return coefficients (a, b, c, d, e, f) of affine transform from map coordinates
+    to canvas pixels: px = a*x + b*y + c, py = d*x + e*y + f """
+    p0 = map_to_pixel.transform(0, 0)
+    p1 = map_to_pixel.transform(1, 0)
+    p2 = map_to_pixel.transform(0, 1)
+    return (p1.x() - p0.x(), p2.x() - p0.x(), p0.x(),
+            p1.y() - p0.y(), p2.y() - p0.y(), p0.y())
+
+
+class NodeMarkersItem(QgsMapCanvasItem):
+    """ Canvas item that paints markers of (possibly very many) nodes at once.
+    Map coordinates of the nodes are kept in arrays. Only nodes within the visible
+    extent are painted and nodes falling into the same pixel are painted just once.
+    When there are too many visible nodes, they are painted as dots in a single call. """
+
+    MAX_CIRCLES = 2000   # above this number of visible nodes, simple dots are painted
+
+    def __init__(self, canvas):
+        QgsMapCanvasItem.__init__(self, canvas)
+        self.map_canvas = canvas
+        self.color = QColor(Qt.blue)
+        self.icon_size = 10
+        self.xs = array('d')
+        self.ys = array('d')
+        self.setZValue(100)
+        self.updatePosition()
+
+    def set_points(self, xs, ys):
+        """ Replace all nodes by the given arrays of map coordinates """
+        self.xs = array('d', xs)
+        self.ys = array('d', ys)
+        self.update()
+
+    def add_points(self, xs, ys):
+        """ Add more nodes given by arrays of map coordinates """
+        self.xs.extend(xs)
+        self.ys.extend(ys)
+        self.update()
+
+    def clear(self):
+        self.set_points([], [])
+
+    def count(self):
+        return len(self.xs)
+
+    def updatePosition(self):
+        # the item always covers the whole visible extent
+        self.setRect(self.map_canvas.mapSettings().visibleExtent())
+
+    def paint(self, painter):
+        if len(self.xs) == 0:
+            return
+
+        a, b, c, d, e, f = _map_to_pixel_affine(self.map_canvas.getCoordinateTransform())
+        c -= self.pos().x()   # painter is in item's coordinates
+        f -= self.pos().y()
+        width, height = self.map_canvas.width(), self.map_canvas.height()
+        margin = self.icon_size
+
+        if numpy is not None:
+            xs = numpy.frombuffer(self.xs, dtype=numpy.float64)
+            ys = numpy.frombuffer(self.ys, dtype=numpy.float64)
+            px = a*xs + b*ys + c
+            py = d*xs + e*ys + f
+            visible = (px >= -margin) & (px <= width+margin) & (py >= -margin) & (py <= height+margin)
+            px, py = numpy.rint(px[visible]), numpy.rint(py[visible])
+            # paint each pixel only once
+            keys = numpy.unique((px + margin) * (height + 2*margin + 1) + (py + margin))
+            px = numpy.floor(keys / (height + 2*margin + 1)) - margin
+            py = keys - (px + margin) * (height + 2*margin + 1) - margin
+        else:
+            pixels = set()
+            for i in xrange(len(self.xs)):
+                x, y = self.xs[i], self.ys[i]
+                pt = (round(a*x + b*y + c), round(d*x + e*y + f))
+                if -margin <= pt[0] <= width+margin and -margin <= pt[1] <= height+margin:
+                    pixels.add(pt)
+            px = [pt[0] for pt in pixels]
+            py = [pt[1] for pt in pixels]
+
+        if len(px) == 0:
+            return
+
+        painter.setRenderHint(QPainter.Antialiasing)
+        if len(px) <= self.MAX_CIRCLES:
+            painter.setPen(QPen(self.color, 1))
+            painter.setBrush(Qt.NoBrush)
+            s = self.icon_size / 2.
+            for i in xrange(len(px)):
+                painter.drawEllipse(QPointF(px[i], py[i]), s, s)
+        else:
+            pen = QPen(self.color, 3)
+            pen.setCapStyle(Qt.RoundCap)
+            painter.setPen(pen)
+            painter.drawPoints(polygon_from_arrays(px, py))
+
+
+class DragPreviewItem(QgsMapCanvasItem):
+    """ Canvas item showing all segments affected by dragging of vertices or edges.
+    There are moving points (following the mouse) and fixed anchor points - each anchor
+    is connected by a segment to one moving point and moving points may be connected
+    by segments as well. All coordinates are kept in arrays (in map units)
+    and all segments are painted with a single call. """
+
+    def __init__(self, canvas):
+        QgsMapCanvasItem.__init__(self, canvas)
+        self.map_canvas = canvas
+        self.pen = QPen(Qt.red)
+        self.moving_xs = array('d')
+        self.moving_ys = array('d')
+        self.anchor_xs = array('d')
+        self.anchor_ys = array('d')
+        self.anchor_moving = array('i')   # index of moving point connected to each anchor
+        self.moving_segments = []         # list of (index_0, index_1) of connected moving points
+        self.moving_dx, self.moving_dy = 0., 0.   # offset applied to all moving points
+        self.setZValue(100)
+        self.updatePosition()
+
+    def set_style(self, color, width):
+        self.pen = QPen(color, width)
+        self.update()
+
+    def add_moving_point(self, pt):
+        """ Add a moving point (QgsPoint in map coordinates) and return its index """
+        self.moving_xs.append(pt.x())
+        self.moving_ys.append(pt.y())
+        self.update()
+        return len(self.moving_xs) - 1
+
+    def add_anchor(self, pt, moving_index):
+        """ Add a fixed point (QgsPoint in map coordinates) connected to the moving point with given index """
+        self.anchor_xs.append(pt.x())
+        self.anchor_ys.append(pt.y())
+        self.anchor_moving.append(moving_index)
+        self.update()
+
+    def add_moving_segment(self, moving_index_0, moving_index_1):
+        """ Connect two moving points by a segment """
+        self.moving_segments.append((moving_index_0, moving_index_1))
+        self.update()
+
+    def set_moving_point(self, moving_index, pt):
+        """ Update position of a moving point (QgsPoint in map coordinates) """
+        self.moving_xs[moving_index] = pt.x()
+        self.moving_ys[moving_index] = pt.y()
+        self.update()
+
+    def set_moving_offset(self, dx, dy):
+        """ Shift all moving points by the given offset (in map units) from their positions """
+        self.moving_dx, self.moving_dy = dx, dy
+        self.update()
+
+    def moving_count(self):
+        return len(self.moving_xs)
+
+    def is_empty(self):
+        return len(self.anchor_xs) == 0 and len(self.moving_segments) == 0
+
+    def clear(self):
+        self.moving_xs, self.moving_ys = array('d'), array('d')
+        self.anchor_xs, self.anchor_ys = array('d'), array('d')
+        self.anchor_moving = array('i')
+        self.moving_segments = []
+        self.moving_dx, self.moving_dy = 0., 0.
+        self.update()
+
+    def updatePosition(self):
+        # the item always covers the whole visible extent
+        self.setRect(self.map_canvas.mapSettings().visibleExtent())
+
+    def paint(self, painter):
+        if self.is_empty():
+            return
+
+        a, b, c, d, e, f = _map_to_pixel_affine(self.map_canvas.getCoordinateTransform())
+        c -= self.pos().x()   # painter is in item's coordinates
+        f -= self.pos().y()
+
+        dx, dy = self.moving_dx, self.moving_dy
+        moving_px = [(a*(x+dx) + b*(y+dy) + c, d*(x+dx) + e*(y+dy) + f) for x, y in zip(self.moving_xs, self.moving_ys)]
+        lines = []
+        for i in xrange(len(self.anchor_xs)):
+            x, y = self.anchor_xs[i], self.anchor_ys[i]
+            mx, my = moving_px[self.anchor_moving[i]]
+            lines.append(QLineF(a*x + b*y + c, d*x + e*y + f, mx, my))
+        for i0, i1 in self.moving_segments:
+            lines.append(QLineF(moving_px[i0][0], moving_px[i0][1], moving_px[i1][0], moving_px[i1][1]))
+
+        painter.setRenderHint(QPainter.Antialiasing)
+        painter.setPen(self.pen)
+        painter.drawLines(lines)
@@ -0,0 +1,156 @@
+#-----------------------------------------------------------
+# Copyright (C) 2015 Martin Dobias
+#-----------------------------------------------------------
+# Licensed under the terms of GNU GPL 2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#---------------------------------------------------------------------
+
+import time
+
+from qgis.core import *
+
+from geomutils import VertexOffsets, vertex_at_vertex_index, move_vertex, delete_vertices, vertex_deletion_changes, ring_is_linear
+from undocommands import VertexDeltaCommand, records_undo, MOVE, INSERT, DELETE
+
+
+class EditApplier(object):
+    """ Collects all geometry changes done by one interaction into a plan
+    { layer : { fid : geometry } } and then applies them with a single edit command
+    and a single repaint for each layer. Repeated edits of the same feature are merged:
+    they all modify the geometry already stored in the plan. Each edited feature's geometry
+    is copied just once - the copy is owned by the plan and it is modified in place.
+    Moves, insertions and deletions of vertices are also recorded as vertex changes,
+    so the undo stack does not need to keep whole geometries (see VertexDeltaCommand). """
+
+    def __init__(self, cache):
+        self.cache = cache      # GeometryCache with the original geometries
+        self.edits = {}         # { layer : { fid : QgsGeometry } }
+        self.changes = {}       # { (layer, fid) : list of vertex changes - or None if the edit is not described by them }
+        self.reshaped = set()   # (layer, fid) of features with added/removed vertices - cached offsets are not valid
+        self.timings = {}       # { phase : duration in seconds } - phases "plan", "apply", "repaint"
+        self.start_time = time.time()
+
+    def geometry(self, layer, fid):
+        """ Return geometry of the feature with all the changes planned so far.
+        The returned geometry is not shared with any other QgsGeometry, so it may be modified
+        in place - and then passed to set_geometry() """
+        features = self.edits.get(layer)
+        if features is not None and fid in features:
+            return features[fid]
+        geom = self.cache.geometry(layer, fid)
+        if geom.geometry() is None:
+            return QgsGeometry()
+        # a deep copy: a copy of QgsGeometry would share data with the cached geometry
+        return QgsGeometry(geom.geometry().clone())
+
+    def vertex_offsets(self, layer, fid):
+        """ Return VertexOffsets of the feature's geometry with all the changes planned so far """
+        if (layer, fid) in self.reshaped:
+            return VertexOffsets(self.edits[layer][fid])
+        return self.cache.vertex_offsets(layer, fid)
+
+    def set_geometry(self, layer, fid, geom, vertices_changed=False):
+        """ Plan change of feature's geometry. If vertices have been added or removed,
+        vertices_changed must be True. The undo stack will keep the whole old and new geometry """
+        self._plan(layer, fid, geom, None, vertices_changed)
+
+    def move_vertex(self, layer, fid, vertex_index, x, y):
+        """ Plan move of the vertex at given index to (x, y) in layer coordinates. Returns False on failure """
+        geom = self.geometry(layer, fid)
+        offsets = self.vertex_offsets(layer, fid)
+        vertex_tuple = offsets.to_tuple(vertex_index)
+        if vertex_tuple is None:
+            return False
+        old_point = vertex_at_vertex_index(geom, vertex_index, offsets)
+        if not move_vertex(geom, vertex_index, x, y, offsets):
+            return False
+        self._plan(layer, fid, geom, [(MOVE,) + vertex_tuple + (old_point.x(), old_point.y(), x, y)])
+        return True
+
+    def insert_vertex(self, layer, fid, part, ring, vertex, x, y):
+        """ Plan insertion of a vertex at (x, y) in layer coordinates before the given vertex
+        (vertex equal to the number of ring's vertices appends it). Returns False on failure """
+        geom = self.geometry(layer, fid)
+        if not geom.geometry().insertVertex(QgsVertexId(part, ring, vertex, QgsVertexId.SegmentVertex), QgsPointV2(x, y)):
+            return False
+        # insertion to a curve may add more than one vertex
+        changes = [(INSERT, part, ring, vertex, x, y)] if ring_is_linear(geom, part, ring) else None
+        self._plan(layer, fid, geom, changes, True)
+        return True
+
+    def delete_vertices(self, layer, fid, vertex_indices):
+        """ Plan deletion of vertices at given indices (all at once). Returns False on failure """
+        features = self.edits.get(layer)
+        geom = features[fid] if features is not None and fid in features else self.cache.geometry(layer, fid)
+        offsets = self.vertex_offsets(layer, fid)
+        res, new_geom = delete_vertices(geom, vertex_indices, offsets)   # works on a copy
+        if not res:
+            return False
+        changes = vertex_deletion_changes(geom, vertex_indices, offsets)
+        if changes is not None:
+            changes = [(DELETE,) + change for change in changes]
+        self._plan(layer, fid, new_geom if new_geom is not None else QgsGeometry(), changes, True)
+        return True
+
+    def discard_layer(self, layer):
+        """ Drop all changes planned for the layer """
+        for fid in self.edits.pop(layer, {}):
+            self.changes.pop((layer, fid), None)
+            self.reshaped.discard((layer, fid))
+
+    def _plan(self, layer, fid, geom, changes, vertices_changed=False):
+        key = (layer, fid)
+        self.edits.setdefault(layer, {})[fid] = geom
+        if changes is None or (key in self.changes and self.changes[key] is None):
+            self.changes[key] = None   # once a snapshot, always a snapshot
+        else:
+            self.changes.setdefault(key, []).extend(changes)
+        if vertices_changed:
+            self.reshaped.add(key)
+
+    def apply(self, text):
+        """ Apply all planned changes to layers - each layer gets one edit command with the given text.
+        If a change of a layer fails, none of the layer's changes are kept """
+        t0 = time.time()
+        self.timings["plan"] = t0 - self.start_time
+
+        applied = []
+        for layer, features in self.edits.iteritems():
+            deltas = [(fid, geom, self.changes[(layer, fid)]) for fid, geom in features.iteritems()
+                      if self.changes[(layer, fid)] is not None]
+            snapshots = [(fid, geom) for fid, geom in features.iteritems() if self.changes[(layer, fid)] is None]
+
+            layer.beginEditCommand(text)
+            # the layer checks provider's capabilities, updates extent and records undo. Changes described
+            # by vertex changes go first: the delta command is the last command pushed and the layer's
+            # commands with whole geometries get merged into it
+            if len(deltas) != 0 and records_undo(layer):
+                command = VertexDeltaCommand(layer)
+                layer.undoStack().push(command)
+                change_geometry = command.change_geometry
+            else:
+                change_geometry = lambda fid, geom, changes: layer.changeGeometry(fid, geom)
+            if all(change_geometry(fid, geom, changes) for fid, geom, changes in deltas) and \
+                    all(layer.changeGeometry(fid, geom) for fid, geom in snapshots):
+                layer.endEditCommand()
+                applied.append(layer)
+                for fid, geom in features.iteritems():
+                    self.cache.set_geometry(layer, fid, geom)   # no need to fetch it again
+            else:
+                print "failed to change geometry!", layer.name()
+                layer.destroyEditCommand()
+
+        t1 = time.time()
+        self.timings["apply"] = t1 - t0
+
+        for layer in applied:
+            layer.triggerRepaint()
+
+        self.timings["repaint"] = time.time() - t1
+        self.edits = {}
+        self.changes = {}
+        self.reshaped = set()
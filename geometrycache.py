@@ -0,0 +1,259 @@
+#-----------------------------------------------------------
+# Copyright (C) 2015 Martin Dobias
+#-----------------------------------------------------------
+# Licensed under the terms of GNU GPL 2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#---------------------------------------------------------------------
+
+from collections import OrderedDict
+
+from PyQt4.QtCore import *
+
+from qgis.core import *
+
+from geomutils import VertexOffsets, VertexMetadata, vertex_coordinates
+
+
+DEFAULT_BUDGET_MB = 256
+
+# rough per-entry overhead of QgsGeometry + abstract geometry + dict entry
+ENTRY_OVERHEAD = 200
+
+
+class _CacheEntry(object):
+    __slots__ = ('geometry', 'size', 'offsets', 'metadata', 'coordinates')
+
+    def __init__(self, geometry):
+        self.geometry = geometry
+        # data derived from the geometry - created on demand
+        self.offsets = None       # VertexOffsets
+        self.metadata = None      # VertexMetadata
+        self.coordinates = None   # tuple (xs, ys)
+        self.size = geometry.wkbSize() + ENTRY_OVERHEAD if geometry.geometry() is not None else ENTRY_OVERHEAD
+
+
+class GeometryCache(QObject):
+    """ Cache of feature geometries of editable layers, limited by memory budget.
+    Least recently used geometries are evicted when the budget is exceeded.
+    Geometries are kept in sync with layers' edit buffers: changed features are just
+    marked dirty and all dirty entries are dropped in one pass (when the event loop gets
+    to it or before the next lookup), new geometries are fetched only when needed.
+    All geometries of a layer are dropped when the layer is reloaded, when its editing
+    is stopped (commit or rollback) or when it is removed from the project. """
+
+    def __init__(self, request_stats, parent=None):
+        QObject.__init__(self, parent)
+        self.request_stats = request_stats   # RequestStats used to fetch features
+
+        budget_mb = QSettings().value("/CadNodeTool/cache_budget_mb", DEFAULT_BUDGET_MB, type=int)
+        self.budget = budget_mb * 1024 * 1024   # maximum size of cached geometries (in bytes)
+
+        self.entries = OrderedDict()   # { (layer, fid) : _CacheEntry } - least recently used first
+        self.layers = {}               # { layer : set of fids } - for quick dropping of a layer
+        self.layer_bytes = {}          # { layer : size of cached geometries in bytes }
+        self.bytes = 0
+
+        self.dirty = {}                # { layer : set of fids } - changed or deleted since cached
+        self.flush_scheduled = False   # whether flush_dirty() is going to be called from the event loop
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        QgsMapLayerRegistry.instance().layersWillBeRemoved.connect(self.on_layers_will_be_removed)
+
+    def set_budget(self, budget):
+        """ Set maximum size of cached geometries in bytes """
+        self.budget = budget
+        self._evict()
+
+    def geometry(self, layer, fid):
+        """ Return geometry of the given feature (fetching it from the layer if not cached yet) """
+        if self.dirty:
+            self.flush_dirty()
+        key = (layer, fid)
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.hits += 1
+            self.entries[key] = entry   # move to the end - most recently used
+            return entry.geometry
+
+        self.misses += 1
+        f = self.request_stats.get_features(layer, QgsFeatureRequest(fid).setSubsetOfAttributes([])).next()
+        geom = QgsGeometry(f.geometry())
+        self._insert(layer, fid, geom)
+        return geom
+
+    def contains(self, layer, fid):
+        """ Return whether geometry of the feature is cached (without fetching it) """
+        if self.dirty:
+            self.flush_dirty()
+        return (layer, fid) in self.entries
+
+    def vertex_offsets(self, layer, fid):
+        """ Return VertexOffsets table of the given feature (built once per cached geometry) """
+        entry = self._entry(layer, fid)
+        if entry.offsets is None:
+            entry.offsets = VertexOffsets(entry.geometry)
+            self._add_size(layer, entry, 12 * len(entry.offsets.starts))
+        return entry.offsets
+
+    def vertex_metadata(self, layer, fid):
+        """ Return VertexMetadata of the given feature (built once per cached geometry) """
+        entry = self._entry(layer, fid)
+        if entry.metadata is None:
+            offsets = self.vertex_offsets(layer, fid)
+            entry.metadata = VertexMetadata(entry.geometry, offsets)
+            self._add_size(layer, entry, 10 * offsets.vertex_count())
+        return entry.metadata
+
+    def vertex_coordinates(self, layer, fid):
+        """ Return tuple (xs, ys) with arrays of coordinates of the given feature's vertices """
+        entry = self._entry(layer, fid)
+        if entry.coordinates is None:
+            entry.coordinates = vertex_coordinates(entry.geometry)
+            self._add_size(layer, entry, 16 * len(entry.coordinates[0]))
+        return entry.coordinates
+
+    def prefetch(self, layer, fids):
+        """ Make sure geometries of given features are cached. All missing geometries
+        are fetched from the layer with a single request """
+        if self.dirty:
+            self.flush_dirty()
+        missing = set(fid for fid in fids if (layer, fid) not in self.entries)
+        if len(missing) == 0:
+            return
+
+        self.misses += len(missing)
+        request = QgsFeatureRequest().setFilterFids(missing).setSubsetOfAttributes([])
+        for f in self.request_stats.get_features(layer, request):
+            self._insert(layer, f.id(), QgsGeometry(f.geometry()))
+
+    def add(self, layer, fid, geom):
+        """ Store geometry of a feature that has been fetched elsewhere (e.g. by a rect request)
+        unless it is cached already - so it does not need to be fetched again """
+        if self.dirty:
+            self.flush_dirty()
+        if (layer, fid) not in self.entries:
+            self._insert(layer, fid, QgsGeometry(geom))
+
+    def set_geometry(self, layer, fid, geom):
+        """ Store geometry of a feature that has just been changed by the node tool,
+        so it does not need to be fetched again. The geometry must not be modified afterwards """
+        fids = self.dirty.get(layer)
+        if fids is not None:
+            fids.discard(fid)
+        if (layer, fid) in self.entries:
+            self._remove(layer, fid)
+        self._insert(layer, fid, geom)
+
+    def flush_dirty(self):
+        """ Drop entries of all features that have been changed or deleted since the last flush """
+        self.flush_scheduled = False
+        dirty, self.dirty = self.dirty, {}
+        for layer, fids in dirty.iteritems():
+            for fid in fids:
+                if (layer, fid) in self.entries:
+                    self._remove(layer, fid)
+
+    def stats(self):
+        """ Return dictionary with cache statistics (counters and memory usage) """
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self.entries),
+            "bytes": self.bytes,
+            "budget": self.budget,
+            "layers": dict((layer.id(), size) for layer, size in self.layer_bytes.iteritems()),
+        }
+
+    def clear(self):
+        for layer in self.layers.keys():
+            self.drop_layer(layer)
+
+    def drop_layer(self, layer):
+        """ Remove all cached geometries of the layer and stop watching it """
+        if layer not in self.layers:
+            return
+        for fid in self.layers[layer]:
+            del self.entries[(layer, fid)]
+        self.bytes -= self.layer_bytes[layer]
+        del self.layers[layer]
+        del self.layer_bytes[layer]
+        self.dirty.pop(layer, None)
+
+        layer.geometryChanged.disconnect(self.on_cached_geometry_changed)
+        layer.featureDeleted.disconnect(self.on_cached_geometry_deleted)
+        layer.editingStopped.disconnect(self.on_editing_stopped)
+        layer.dataChanged.disconnect(self.on_data_changed)
+
+    def _insert(self, layer, fid, geom):
+        if layer not in self.layers:
+            self.layers[layer] = set()
+            self.layer_bytes[layer] = 0
+            layer.geometryChanged.connect(self.on_cached_geometry_changed)
+            layer.featureDeleted.connect(self.on_cached_geometry_deleted)
+            layer.editingStopped.connect(self.on_editing_stopped)
+            layer.dataChanged.connect(self.on_data_changed)
+
+        entry = _CacheEntry(geom)
+        self.entries[(layer, fid)] = entry
+        self.layers[layer].add(fid)
+        self.layer_bytes[layer] += entry.size
+        self.bytes += entry.size
+        self._evict()
+
+    def _entry(self, layer, fid):
+        self.geometry(layer, fid)
+        return self.entries[(layer, fid)]
+
+    def _add_size(self, layer, entry, size):
+        """ Account memory used by data derived from the geometry """
+        entry.size += size
+        self.layer_bytes[layer] += size
+        self.bytes += size
+
+    def _remove(self, layer, fid):
+        entry = self.entries.pop((layer, fid))
+        self.layers[layer].discard(fid)
+        self.layer_bytes[layer] -= entry.size
+        self.bytes -= entry.size
+
+    def _evict(self):
+        # always keep at least the most recently used entry
+        while self.bytes > self.budget and len(self.entries) > 1:
+            layer, fid = next(iter(self.entries))
+            self._remove(layer, fid)
+            self.evictions += 1
+
+    def _mark_dirty(self, layer, fid):
+        if (layer, fid) not in self.entries:
+            return
+        self.dirty.setdefault(layer, set()).add(fid)
+        if not self.flush_scheduled:
+            # there may be many more changes coming (e.g. undo of a large edit) - handle them at once
+            self.flush_scheduled = True
+            QTimer.singleShot(0, self.flush_dirty)
+
+    def on_cached_geometry_changed(self, fid, geom):
+        self._mark_dirty(self.sender(), fid)
+
+    def on_cached_geometry_deleted(self, fid):
+        self._mark_dirty(self.sender(), fid)
+
+    def on_editing_stopped(self):
+        self.drop_layer(self.sender())
+
+    def on_data_changed(self):
+        # the layer has been reloaded - nothing we have may be valid anymore
+        self.drop_layer(self.sender())
+
+    def on_layers_will_be_removed(self, layer_ids):
+        for layer in self.layers.keys():
+            if layer.id() in layer_ids:
+                self.drop_layer(layer)
@@ -0,0 +1,73 @@
+
+""" Small geometric routines on plain floats for the hot paths of the node tool
+(hover over vertices and edges). Nothing here creates QgsPoint/QgsGeometry instances
+or calls GEOS - coordinates are passed and returned as floats. """
+
+
+def sqr_dist(x0, y0, x1, y1):
+    """ Squared distance between two points """
+    dx, dy = x1 - x0, y1 - y0
+    return dx*dx + dy*dy
+
+
+def midpoint(x0, y0, x1, y1):
+    """ Return tuple (x, y) of the point in the middle of the segment """
+    return (x0 + x1) / 2., (y0 + y1) / 2.
+
+
+def clip_segment(x0, y0, x1, y1, xmin, ymin, xmax, ymax):
+    """ Clip segment to the rectangle (Liang-Barsky). Returns tuple (x0, y0, x1, y1)
+    of the clipped segment or None if the segment is completely outside """
+    dx, dy = x1 - x0, y1 - y0
+    t0, t1 = 0., 1.
+    for p, q in ((-dx, x0 - xmin), (dx, xmax - x0), (-dy, y0 - ymin), (dy, ymax - y0)):
+        if p == 0:
+            if q < 0:
+                return None   # parallel with the boundary and outside of it
+            continue
+        t = float(q) / p
+        if p < 0:
+            if t > t1:
+                return None
+            if t > t0:
+                t0 = t
+        else:
+            if t < t0:
+                return None
+            if t < t1:
+                t1 = t
+    return x0 + t0*dx, y0 + t0*dy, x0 + t1*dx, y0 + t1*dy
+
+
+def visible_midpoint(x0, y0, x1, y1, xmin, ymin, xmax, ymax):
+    """ Return tuple (x, y) of the middle of the part of the segment within the rectangle
+    (or of the whole segment if it is completely outside) """
+    clipped = clip_segment(x0, y0, x1, y1, xmin, ymin, xmax, ymax)
+    if clipped is None:
+        return midpoint(x0, y0, x1, y1)
+    return midpoint(*clipped)
+
+
+def extend_from_endpoint(x_prev, y_prev, x_end, y_end, dist):
+    """ Return tuple (x, y) of the point at given distance beyond the endpoint,
+    in the direction of the segment from the previous vertex to the endpoint """
+    dx, dy = x_end - x_prev, y_end - y_prev
+    length_sqr = dx*dx + dy*dy
+    if length_sqr == 0:
+        return x_end + dist, y_end   # no direction - same as with atan2(0, 0)
+    k = dist / length_sqr ** .5
+    return x_end + dx*k, y_end + dy*k
+
+
+if True:  # testing
+    assert sqr_dist(0, 0, 3, 4) == 25
+    assert midpoint(0, 0, 3, 1) == (1.5, .5)
+    assert clip_segment(1, 1, 2, 2, 0, 0, 4, 4) == (1, 1, 2, 2)
+    assert clip_segment(-2, 1, 6, 1, 0, 0, 4, 4) == (0, 1, 4, 1)
+    assert clip_segment(-2, -2, 6, 6, 0, 0, 4, 4) == (0, 0, 4, 4)
+    assert clip_segment(5, 0, 5, 4, 0, 0, 4, 4) is None
+    assert clip_segment(-1, 4, 3, 8, 0, 0, 4, 4) is None
+    assert visible_midpoint(-2, 1, 2, 1, 0, 0, 4, 4) == (1, 1)
+    assert visible_midpoint(5, 0, 5, 2, 0, 0, 4, 4) == (5, 1)
+    assert extend_from_endpoint(0, 0, 3, 4, 5) == (6, 8)
+    assert extend_from_endpoint(1, 1, 1, 1, 2) == (3, 1)
@@ -1,94 +1,402 @@
 
+from array import array
+from bisect import bisect_left, bisect_right
+
+from PyQt4.QtGui import *
+from PyQt4.QtCore import *
+
 from qgis.core import *
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
-def is_endpoint_at_vertex_index(geom, vertex_index):
-    """ Find out whether vertex at the given index is an endpoint (assuming linear geometry) """
 
-    g = geom.geometry()
-    if isinstance(g, QgsCurveV2):
-        return vertex_index == 0 or vertex_index == g.numPoints()-1
-    elif isinstance(g, QgsMultiCurveV2):
-        for i in xrange(g.numGeometries()):
-            part = g.geometryN(i)
-            if vertex_index < part.numPoints():
-                return vertex_index == 0 or vertex_index == part.numPoints()-1
-            vertex_index -= part.numPoints()
-    else:
-        assert False
-
-
-def vertex_at_vertex_index(geom, vertex_index):
+class VertexOffsets(object):
+    """ Table of vertex index offsets of all rings (parts of curves count as rings) of a geometry.
+    It is built once for a geometry and then allows translation of vertex index
+    to (part, ring, vertex) tuple in O(log n) using binary search """
+
+    def __init__(self, geom):
+        g = geom.geometry() if isinstance(geom, QgsGeometry) else geom
+        self.starts = array('i')   # vertex index of the first vertex of each ring (+ total count at the end)
+        self.parts = array('i')    # part index of each ring
+        self.rings = array('i')    # ring index (within its part) of each ring
+
+        offset = 0
+        parts = [g.geometryN(i) for i in xrange(g.numGeometries())] if isinstance(g, QgsGeometryCollectionV2) else [g]
+        for part_index, part in enumerate(parts):
+            if isinstance(part, QgsCurvePolygonV2):
+                rings = [part.exteriorRing()] + [part.interiorRing(i) for i in xrange(part.numInteriorRings())]
+            else:
+                rings = [part]
+            for ring_index, ring in enumerate(rings):
+                if ring is None:
+                    continue
+                self.starts.append(offset)
+                self.parts.append(part_index)
+                self.rings.append(ring_index)
+                offset += ring.nCoordinates()
+        self.starts.append(offset)
+
+    def vertex_count(self):
+        return self.starts[-1]
+
+    def ring_slot(self, vertex_index):
+        """ Return index of the ring containing the vertex (or -1 if the index is not valid) """
+        if vertex_index < 0 or vertex_index >= self.starts[-1]:
+            return -1
+        return bisect_right(self.starts, vertex_index) - 1
+
+    def ring_range(self, vertex_index):
+        """ Return tuple (first, last) with vertex indices of the ring containing the vertex """
+        slot = self.ring_slot(vertex_index)
+        if slot == -1:
+            return None
+        return self.starts[slot], self.starts[slot+1]-1
+
+    def to_tuple(self, vertex_index):
+        """ Return a tuple (part, ring, vertex) from vertex index (or None if the index is not valid) """
+        slot = self.ring_slot(vertex_index)
+        if slot == -1:
+            return None
+        return self.parts[slot], self.rings[slot], vertex_index - self.starts[slot]
+
+
+def _ring_geometry(g, part_index, ring_index):
+    """ Get curve (or point) within abstract geometry at given part and ring index """
+    if isinstance(g, QgsGeometryCollectionV2):
+        g = g.geometryN(part_index)
+    if isinstance(g, QgsCurvePolygonV2):
+        g = g.exteriorRing() if ring_index == 0 else g.interiorRing(ring_index - 1)
+    return g
+
+
+def _is_polygon_ring(g, part_index):
+    """ Find out whether rings of the part at given index belong to a polygon (closed lines are not rings) """
+    if isinstance(g, QgsGeometryCollectionV2):
+        g = g.geometryN(part_index)
+    return isinstance(g, QgsCurvePolygonV2)
+
+
+class VertexMetadata(object):
+    """ Information about all vertices of a geometry stored in compact arrays indexed by vertex index:
+    whether the vertex is a curve vertex, whether it is an endpoint of a part/ring and indices
+    of previous and next vertex (-1 if there is none). Polygon rings wrap around like
+    QgsGeometry.adjacentVertices() does """
+
+    def __init__(self, geom, offsets=None):
+        if offsets is None:
+            offsets = VertexOffsets(geom)
+        n = offsets.vertex_count()
+        self.curve = array('b', [0]) * n
+        self.endpoint = array('b', [0]) * n
+        self.prev = array('i', [-1]) * n
+        self.next = array('i', [-1]) * n
+
+        g = geom.geometry()
+        p = QgsPointV2()
+        for slot in xrange(len(offsets.starts)-1):
+            first, last = offsets.starts[slot], offsets.starts[slot+1]-1
+            ring = _ring_geometry(g, offsets.parts[slot], offsets.rings[slot])
+            if not isinstance(ring, QgsCurveV2):
+                self.endpoint[first] = 1   # standalone point
+                continue
+
+            self.endpoint[first] = 1
+            self.endpoint[last] = 1
+            for i in xrange(first, last):
+                self.next[i] = i+1
+                self.prev[i+1] = i
+            if last - first >= 2 and _is_polygon_ring(g, offsets.parts[slot]) and ring.isClosed():
+                self.prev[first] = last-1
+                self.next[last] = first+1
+
+            if not isinstance(ring, QgsLineStringV2):
+                for i in xrange(first, last+1):
+                    res, v_type = ring.pointAt(i-first, p)
+                    if res and v_type == QgsVertexId.CurveVertex:
+                        self.curve[i] = 1
+
+
+def is_endpoint_at_vertex_index(geom, vertex_index, offsets=None):
+    """ Find out whether vertex at the given index is an endpoint (assuming linear geometry).
+    For polygons the first and the last vertex of each ring are considered endpoints """
+    if offsets is None:
+        offsets = VertexOffsets(geom)
+    rng = offsets.ring_range(vertex_index)
+    if rng is None:
+        return False
+    return vertex_index == rng[0] or vertex_index == rng[1]
+
+
+def vertex_at_vertex_index(geom, vertex_index, offsets=None):
     """ Get coordinates of the vertex at particular index """
-    g = geom.geometry()
+    if offsets is None:
+        offsets = VertexOffsets(geom)
+    t = offsets.to_tuple(vertex_index)
+    if t is None:
+        return QgsPoint()
+    ring = _ring_geometry(geom.geometry(), t[0], t[1])
+    if isinstance(ring, QgsPointV2):
+        return QgsPoint(ring.x(), ring.y())
     p = QgsPointV2()
-    if isinstance(g, QgsCurveV2):
-        g.pointAt(vertex_index, p)
-    elif isinstance(g, QgsMultiCurveV2):
-        for i in xrange(g.numGeometries()):
-            part = g.geometryN(i)
-            if vertex_index < part.numPoints():
-                part.pointAt(vertex_index, p)
-                break
-            vertex_index -= part.numPoints()
-    else:
-        assert False
+    ring.pointAt(t[2], p)
     return QgsPoint(p.x(), p.y())
 
 
-def adjacent_vertex_index_to_endpoint(geom, vertex_index):
+def adjacent_vertex_index_to_endpoint(geom, vertex_index, offsets=None):
     """ Return index of vertex adjacent to the given endpoint. Assuming linear geometries. """
+    if offsets is None:
+        offsets = VertexOffsets(geom)
+    first, last = offsets.ring_range(vertex_index)
+    return first+1 if vertex_index == first else last-1
+
+
+def vertex_index_to_tuple(g, vertex_index, offsets=None):
+    """ Return a tuple (part, ring, vertex) from vertex index """
+    if offsets is None:
+        offsets = VertexOffsets(g)
+    return offsets.to_tuple(vertex_index)
+
+
+def move_vertex(geom, vertex_index, x, y, offsets=None):
+    """ Move vertex at given index to (x, y) - the geometry is modified in place, so it must not be
+    shared with other QgsGeometry instances. Unlike QgsGeometry.moveVertex() this does not detach
+    the geometry and it does not build coordinate sequence of the whole geometry to find the vertex.
+    Returns False if the vertex index is not valid. """
+    if offsets is None:
+        offsets = VertexOffsets(geom)
+    vertex_tuple = offsets.to_tuple(vertex_index)
+    if vertex_tuple is None:
+        return False
+    part, ring, vertex = vertex_tuple
+    return geom.geometry().moveVertex(QgsVertexId(part, ring, vertex, QgsVertexId.SegmentVertex), QgsPointV2(x, y))
+
+
+def delete_vertices(geom, vertex_indices, offsets=None):
+    """ Delete vertices at given indices from the geometry in one pass.
+    Returns tuple (success, new_geometry) - new geometry is None if there are no vertices left.
+    Lines with less than two vertices and rings with less than three distinct vertices are removed
+    (removal of polygon's exterior ring removes the whole polygon). Linear rings are rebuilt at once,
+    curved rings fall back to deletion of vertices one by one. """
+    if offsets is None:
+        offsets = VertexOffsets(geom)
+
+    to_delete = {}   # { ring slot : set of vertex indices within the ring }
+    for vertex_index in vertex_indices:
+        slot = offsets.ring_slot(vertex_index)
+        if slot != -1:
+            to_delete.setdefault(slot, set()).add(vertex_index - offsets.starts[slot])
+
+    g = geom.geometry().clone()
+    success = True
+
+    # going from the last ring so that removal of rings and parts does not change indices of the rest
+    for slot in sorted(to_delete.keys(), reverse=True):
+        part_index, ring_index = offsets.parts[slot], offsets.rings[slot]
+        ring = _ring_geometry(g, part_index, ring_index)
+        ring_vertices = to_delete[slot]
+
+        if isinstance(ring, QgsLineStringV2):
+            points = ring.points()
+            closed = len(points) > 1 and _is_polygon_ring(g, part_index) and ring.isClosed()
+            if closed:
+                # the closing vertex is the same as the first one
+                if len(points)-1 in ring_vertices:
+                    ring_vertices.add(0)
+                points = points[:-1]
+            points = [pt for i, pt in enumerate(points) if i not in ring_vertices]
+            if closed and len(points) > 0:
+                points.append(QgsPointV2(points[0]))
+            degenerate = len(points) < (4 if closed else 2)
+            if not degenerate:
+                ring.setPoints(points)
+        elif isinstance(ring, QgsCurveV2):
+            for vertex in sorted(ring_vertices, reverse=True):
+                if not g.deleteVertex(QgsVertexId(part_index, ring_index, vertex, QgsVertexId.SegmentVertex)):
+                    success = False
+            continue   # removal of degenerate curves is done by deleteVertex()
+        else:
+            degenerate = True   # point
+
+        if not degenerate:
+            continue
+        if isinstance(g, QgsGeometryCollectionV2):
+            part = g.geometryN(part_index)
+            if isinstance(part, QgsCurvePolygonV2) and ring_index > 0:
+                part.removeInteriorRing(ring_index - 1)
+            else:
+                g.removeGeometry(part_index)
+        elif isinstance(g, QgsCurvePolygonV2) and ring_index > 0:
+            g.removeInteriorRing(ring_index - 1)
+        else:
+            return success, None
+
+    if g.nCoordinates() == 0:
+        return success, None
+    return success, QgsGeometry(g)
+
+
+def vertex_deletion_changes(geom, vertex_indices, offsets=None):
+    """ Describe deletion of vertices at given indices as a list of tuples (part, ring, vertex, x, y)
+    of vertices removed one by one in that order - reinserting them in reverse order undoes the deletion.
+    Returns None if the deletion is more than that: a ring or a part gets removed, a curve or the first/last
+    vertex of a polygon ring is involved, or the geometry has z/m values that would not be restored """
+    if offsets is None:
+        offsets = VertexOffsets(geom)
     g = geom.geometry()
-    if isinstance(g, QgsCurveV2):
-        return 1 if vertex_index == 0 else g.numPoints()-2
-    elif isinstance(g, QgsMultiCurveV2):
-        offset = 0
-        for i in xrange(g.numGeometries()):
-            part = g.geometryN(i)
-            if vertex_index < part.numPoints():
-                return offset+1 if vertex_index == 0 else offset+part.numPoints()-2
-            vertex_index -= part.numPoints()
-            offset += part.numPoints()
-    else:
-        assert False
+    if g is None or QgsWKBTypes.hasZ(g.wkbType()) or QgsWKBTypes.hasM(g.wkbType()):
+        return None
 
+    to_delete = {}   # { ring slot : set of vertex indices within the ring }
+    for vertex_index in vertex_indices:
+        slot = offsets.ring_slot(vertex_index)
+        if slot != -1:
+            to_delete.setdefault(slot, set()).add(vertex_index - offsets.starts[slot])
 
-def vertex_index_to_tuple(g, vertex_index):
-    """ Return a tuple (part, vertex) from vertex index """
+    changes = []
+    for slot in sorted(to_delete.keys(), reverse=True):
+        part_index, ring_index = offsets.parts[slot], offsets.rings[slot]
+        ring = _ring_geometry(g, part_index, ring_index)
+        if not isinstance(ring, QgsLineStringV2):
+            return None
+        ring_vertices = to_delete[slot]
+        n = ring.numPoints()
+        closed = n > 1 and _is_polygon_ring(g, part_index) and ring.isClosed()
+        if closed and (0 in ring_vertices or n-1 in ring_vertices):
+            return None
+        if n - len(ring_vertices) < (4 if closed else 2):
+            return None
+        for vertex in sorted(ring_vertices, reverse=True):
+            pt = ring.pointN(vertex)
+            changes.append((part_index, ring_index, vertex, pt.x(), pt.y()))
+    return changes
 
-    if isinstance(g, QgsGeometry):
-        g = g.geometry()
 
-    if isinstance(g, QgsGeometryCollectionV2):
-        part_index = 0
-        offset = 0
-        for i in xrange(g.numGeometries()):
-            part = g.geometryN(i)
-            if vertex_index < part.numPoints():
-                (_,ring_index,vertex) = vertex_index_to_tuple(part, vertex_index)
-                return (part_index, ring_index, vertex)
-            vertex_index -= part.numPoints()
-            offset += part.numPoints()
-            part_index += 1
-
-    elif isinstance(g, QgsCurveV2):
-        return (0, 0, vertex_index)
-
-    elif isinstance(g, QgsCurvePolygonV2):
-        ring = g.exteriorRing()
-        if vertex_index < ring.numPoints():
-            return (0, 0, vertex_index)
-        vertex_index -= ring.numPoints()
-        ring_index = 1
-        for i in xrange(g.numInteriorRings()):
-            ring = g.interiorRing(i)
-            if vertex_index < ring.numPoints():
-                return (0, ring_index, vertex_index)
-            vertex_index -= ring.numPoints()
-            ring_index += 1
+def ring_is_linear(geom, part_index, ring_index):
+    """ Find out whether the ring (or line) at given part and ring index is a linestring (not a curve) """
+    return isinstance(_ring_geometry(geom.geometry(), part_index, ring_index), QgsLineStringV2)
+
+
+def vertex_coordinates(geom):
+    """ Get coordinates of all vertices as a tuple of arrays (xs, ys) indexed by vertex index.
+    The geometry is walked just once. Arrays are numpy arrays if numpy is available. """
+    xs, ys = array('d'), array('d')
+    if geom is not None and geom.geometry() is not None:
+        for part in geom.geometry().coordinateSequence():
+            for ring in part:
+                for pt in ring:
+                    xs.append(pt.x())
+                    ys.append(pt.y())
+    if numpy is not None:
+        return numpy.frombuffer(xs, dtype=numpy.float64), numpy.frombuffer(ys, dtype=numpy.float64)
+    return xs, ys
+
+
+def take_coordinates(xs, ys, indices):
+    """ Return tuple (xs, ys) with arrays of coordinates (from vertex_coordinates()) at given indices """
+    if numpy is not None:
+        indices = numpy.asarray(indices, dtype=numpy.intp)
+        return xs[indices], ys[indices]
+    return array('d', (xs[i] for i in indices)), array('d', (ys[i] for i in indices))
+
+
+def concatenate_coordinates(coordinates):
+    """ Join a list of tuples (xs, ys) with arrays of coordinates into one tuple (xs, ys) """
+    if numpy is not None:
+        if len(coordinates) == 0:
+            return numpy.zeros(0), numpy.zeros(0)
+        return numpy.concatenate([xs for xs, _ in coordinates]), numpy.concatenate([ys for _, ys in coordinates])
+    all_xs, all_ys = array('d'), array('d')
+    for xs, ys in coordinates:
+        all_xs.extend(xs)
+        all_ys.extend(ys)
+    return all_xs, all_ys
+
+
+def polygon_from_arrays(xs, ys):
+    """ Create QPolygonF from arrays of x and y coordinates (without a python loop if numpy is available) """
+    n = len(xs)
+    if numpy is None or n == 0:
+        return QPolygonF([QPointF(xs[i], ys[i]) for i in xrange(n)])
+    polygon = QPolygonF(n)
+    ptr = polygon.data()
+    ptr.setsize(n * 16)   # two doubles for each point
+    buf = numpy.frombuffer(ptr, dtype=numpy.float64)
+    buf[0::2] = xs
+    buf[1::2] = ys
+    return polygon
+
+
+def arrays_from_polygon(polygon):
+    """ Get coordinates of QPolygonF points as a tuple of arrays (xs, ys) - the reverse of polygon_from_arrays() """
+    n = polygon.size()
+    if numpy is None or n == 0:
+        return array('d', (polygon.at(i).x() for i in xrange(n))), array('d', (polygon.at(i).y() for i in xrange(n)))
+    ptr = polygon.data()
+    ptr.setsize(n * 16)
+    buf = numpy.frombuffer(ptr, dtype=numpy.float64)
+    return numpy.array(buf[0::2]), numpy.array(buf[1::2])   # copies - the buffer belongs to the polygon
+
+
+def vertex_indices_in_rect(xs, ys, rect):
+    """ Return list of indices of coordinates (from vertex_coordinates()) that are within the rectangle """
+    xmin, xmax = rect.xMinimum(), rect.xMaximum()
+    ymin, ymax = rect.yMinimum(), rect.yMaximum()
+    if numpy is not None:
+        mask = (xs >= xmin) & (xs <= xmax) & (ys >= ymin) & (ys <= ymax)
+        return numpy.flatnonzero(mask).tolist()
+    return [i for i in xrange(len(xs)) if xmin <= xs[i] <= xmax and ymin <= ys[i] <= ymax]
+
+
+def vertex_indices_in_polygon(xs, ys, poly_xs, poly_ys):
+    """ Return sorted list of indices of coordinates (from vertex_coordinates()) that are within the polygon
+    given by arrays of coordinates of its ring (even-odd rule). Points are sorted by y once and then each edge
+    of the polygon is only tested against points within its vertical range, so the cost grows with
+    the number of points times the number of edges crossing a horizontal line, not times all edges """
+    n = len(poly_xs)
+    if n < 3 or len(xs) == 0:
+        return []
+
+    if numpy is not None:
+        xs, ys = numpy.asarray(xs, dtype=numpy.float64), numpy.asarray(ys, dtype=numpy.float64)
+        order = numpy.argsort(ys, kind='mergesort')
+        sorted_xs, sorted_ys = xs[order], ys[order]
+        inside = numpy.zeros(len(xs), dtype=bool)
+        for i in xrange(n):
+            xi, yi, xj, yj = poly_xs[i], poly_ys[i], poly_xs[i-1], poly_ys[i-1]
+            if yi == yj:
+                continue   # horizontal edges never cross the ray
+            lo = numpy.searchsorted(sorted_ys, min(yi, yj), 'left')
+            hi = numpy.searchsorted(sorted_ys, max(yi, yj), 'left')
+            if lo == hi:
+                continue
+            band_ys = sorted_ys[lo:hi]
+            x_cross = xi + (band_ys - yi) * ((xj - xi) / (yj - yi))
+            inside[lo:hi] ^= sorted_xs[lo:hi] < x_cross
+        return numpy.sort(order[inside]).tolist()
+
+    order = sorted(xrange(len(xs)), key=lambda k: ys[k])
+    sorted_ys = [ys[k] for k in order]
+    inside = [False] * len(xs)
+    for i in xrange(n):
+        xi, yi, xj, yj = poly_xs[i], poly_ys[i], poly_xs[i-1], poly_ys[i-1]
+        if yi == yj:
+            continue
+        slope = (xj - xi) / (yj - yi)
+        for k in xrange(bisect_left(sorted_ys, min(yi, yj)), bisect_left(sorted_ys, max(yi, yj))):
+            if xs[order[k]] < xi + (sorted_ys[k] - yi) * slope:
+                inside[k] = not inside[k]
+    return sorted(order[k] for k in xrange(len(order)) if inside[k])
 
 
 if True:  # testing
+    xs, ys = arrays_from_polygon(polygon_from_arrays(array('d', [1, 2, 3]), array('d', [4, 5, 6])))
+    assert list(xs) == [1, 2, 3] and list(ys) == [4, 5, 6]
+    assert len(arrays_from_polygon(polygon_from_arrays(array('d'), array('d')))[0]) == 0
+
     line = QgsGeometry.fromWkt("LINESTRING(1 1, 2 1, 3 2)")
     assert is_endpoint_at_vertex_index(line, 0) == True
     assert is_endpoint_at_vertex_index(line, 1) == False
@@ -122,3 +430,67 @@ if True:  # testing
     assert vertex_index_to_tuple(mline, 2) == (0, 0, 2)
     assert vertex_index_to_tuple(mline, 3) == (1, 0, 0)
     assert vertex_index_to_tuple(mline, 5) == (1, 0, 2)
+    xs, ys = vertex_coordinates(mline)
+    assert list(xs) == [1, 2, 3, 3, 4, 4]
+    assert list(ys) == [1, 1, 2, 3, 3, 2]
+    assert vertex_indices_in_rect(xs, ys, QgsRectangle(1.5, 0, 3, 2.5)) == [1, 2]
+
+    polygon = QgsGeometry.fromWkt("POLYGON((0 0, 4 0, 4 4, 0 4, 0 0), (1 1, 2 1, 2 2, 1 1))")
+    assert is_endpoint_at_vertex_index(polygon, 0) == True
+    assert is_endpoint_at_vertex_index(polygon, 4) == True
+    assert is_endpoint_at_vertex_index(polygon, 5) == True
+    assert is_endpoint_at_vertex_index(polygon, 6) == False
+    assert vertex_at_vertex_index(polygon, 2) == QgsPoint(4, 4)
+    assert vertex_at_vertex_index(polygon, 6) == QgsPoint(2, 1)
+    assert adjacent_vertex_index_to_endpoint(polygon, 8) == 7
+    assert vertex_index_to_tuple(polygon, 4) == (0, 0, 4)
+    assert vertex_index_to_tuple(polygon, 5) == (0, 1, 0)
+    assert vertex_index_to_tuple(polygon, 9) is None
+
+    mpolygon = QgsGeometry.fromWkt("MULTIPOLYGON(((0 0, 1 0, 1 1, 0 0)), ((5 5, 6 5, 6 6, 5 5), (5.1 5.1, 5.2 5.1, 5.2 5.2, 5.1 5.1)))")
+    offsets = VertexOffsets(mpolygon)
+    assert offsets.vertex_count() == 12
+    assert vertex_index_to_tuple(mpolygon, 3, offsets) == (0, 0, 3)
+    assert vertex_index_to_tuple(mpolygon, 4, offsets) == (1, 0, 0)
+    assert vertex_index_to_tuple(mpolygon, 9, offsets) == (1, 1, 1)
+    assert vertex_at_vertex_index(mpolygon, 9, offsets) == QgsPoint(5.2, 5.1)
+
+    meta = VertexMetadata(line)
+    assert list(meta.endpoint) == [1, 0, 1]
+    assert list(meta.prev) == [-1, 0, 1]
+    assert list(meta.next) == [1, 2, -1]
+    meta = VertexMetadata(polygon)
+    assert list(meta.prev[:5]) == [3, 0, 1, 2, 3]
+    assert list(meta.next[:5]) == [1, 2, 3, 4, 1]
+    cline = QgsGeometry.fromWkt("CIRCULARSTRING(0 0, 1 1, 2 0)")
+    assert list(VertexMetadata(cline).curve) == [0, 1, 0]
+
+    assert delete_vertices(mline, [1, 3])[1].exportToWkt() == QgsGeometry.fromWkt("MULTILINESTRING((1 1, 3 2), (4 3, 4 2))").exportToWkt()
+    assert delete_vertices(mline, [0, 1])[1].exportToWkt() == QgsGeometry.fromWkt("MULTILINESTRING((3 3, 4 3, 4 2))").exportToWkt()
+    assert delete_vertices(line, [0, 1, 2]) == (True, None)
+    closed_line = QgsGeometry.fromWkt("LINESTRING(0 0, 1 0, 1 1, 0 0)")
+    assert delete_vertices(closed_line, [1])[1].exportToWkt() == QgsGeometry.fromWkt("LINESTRING(0 0, 1 1, 0 0)").exportToWkt()
+    assert VertexMetadata(closed_line).prev[0] == -1
+    assert delete_vertices(polygon, [0])[1].exportToWkt() == QgsGeometry.fromWkt("POLYGON((4 0, 4 4, 0 4, 4 0), (1 1, 2 1, 2 2, 1 1))").exportToWkt()
+    assert delete_vertices(polygon, [6])[1].exportToWkt() == QgsGeometry.fromWkt("POLYGON((0 0, 4 0, 4 4, 0 4, 0 0))").exportToWkt()
+    assert delete_vertices(mpolygon, [1])[1].exportToWkt() == QgsGeometry.fromWkt("MULTIPOLYGON(((5 5, 6 5, 6 6, 5 5), (5.1 5.1, 5.2 5.1, 5.2 5.2, 5.1 5.1)))").exportToWkt()
+
+    assert vertex_deletion_changes(mline, [1, 4]) == [(1, 0, 1, 4, 3), (0, 0, 1, 2, 1)]
+    assert vertex_deletion_changes(mline, [0, 1]) is None
+    assert vertex_deletion_changes(polygon, [1]) == [(0, 0, 1, 4, 0)]
+    assert vertex_deletion_changes(polygon, [0]) is None
+    assert vertex_deletion_changes(polygon, [6]) is None
+    assert vertex_deletion_changes(closed_line, [0]) == [(0, 0, 0, 0, 0)]
+    assert ring_is_linear(polygon, 0, 1) and not ring_is_linear(cline, 0, 0)
+
+    moved = QgsGeometry(mpolygon.geometry().clone())
+    assert move_vertex(moved, 9, 5.25, 5.1)
+    assert vertex_at_vertex_index(moved, 9) == QgsPoint(5.25, 5.1)
+    assert vertex_at_vertex_index(mpolygon, 9) == QgsPoint(5.2, 5.1)
+    assert move_vertex(moved, 12, 0, 0) == False
+
+    square_xs, square_ys = array('d', [0, 4, 4, 0]), array('d', [0, 0, 4, 4])
+    pts_xs, pts_ys = array('d', [1, 5, 2, -1, 3.9]), array('d', [1, 1, 3.5, 2, 0])
+    assert vertex_indices_in_polygon(pts_xs, pts_ys, square_xs, square_ys) == [0, 2, 4]
+    triangle_xs, triangle_ys = array('d', [0, 4, 0]), array('d', [0, 0, 4])
+    assert vertex_indices_in_polygon(pts_xs, pts_ys, triangle_xs, triangle_ys) == [0, 4]
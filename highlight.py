@@ -0,0 +1,97 @@
+#-----------------------------------------------------------
+# Copyright (C) 2015 Martin Dobias
+#-----------------------------------------------------------
+# Licensed under the terms of GNU GPL 2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#---------------------------------------------------------------------
+
+import math
+from collections import OrderedDict
+
+from PyQt4.QtCore import *
+
+from qgis.core import *
+
+
+class HighlightGeometryCache(QObject):
+    """ Prepares geometries of features for highlighting in a rubber band.
+    Curved geometries are segmentized and all geometries are simplified to a tolerance
+    smaller than a pixel. The result is cached for each scale band (scales within factor of two)
+    and clipped to the visible extent, so the cost of highlighting depends on the size
+    of the screen rather than on the size of the feature. Entries of a layer are dropped
+    when the layer is removed or its editing is stopped. """
+
+    MAX_ENTRIES = 16
+
+    def __init__(self, parent=None):
+        QObject.__init__(self, parent)
+        self.entries = OrderedDict()   # { (layer, fid, scale_band) : (source geometry, simplified geometry) }
+        self.layers = set()            # layers with connected editingStopped signal
+
+        QgsMapLayerRegistry.instance().layersWillBeRemoved.connect(self.on_layers_will_be_removed)
+
+    def geometry(self, layer, fid, source_geom, map_settings):
+        """ Return geometry (in layer coordinates) to be used for highlight of the given feature """
+        visible_extent = map_settings.visibleExtent()
+        layer_extent = map_settings.mapToLayerCoordinates(layer, visible_extent)
+        if layer_extent.isEmpty() or visible_extent.width() == 0:
+            return source_geom
+
+        # size of a pixel in layer units
+        pixel_size = map_settings.mapUnitsPerPixel() * layer_extent.width() / visible_extent.width()
+        scale_band = int(math.floor(math.log(pixel_size, 2)))
+
+        key = (layer, fid, scale_band)
+        entry = self.entries.pop(key, None)
+        if entry is None or entry[0] is not source_geom:   # source geometry has changed?
+            entry = (source_geom, self._simplified_geometry(source_geom, 2 ** scale_band / 2))
+        self.entries[key] = entry
+        if layer not in self.layers:
+            self.layers.add(layer)
+            layer.editingStopped.connect(self.on_editing_stopped)
+        while len(self.entries) > self.MAX_ENTRIES:
+            self.entries.popitem(last=False)
+
+        geom = entry[1]
+
+        # clip to a slightly larger extent so the boundaries created by clipping are not visible
+        clip_rect = QgsRectangle(layer_extent)
+        clip_rect.scale(1.1)
+        if not clip_rect.contains(geom.boundingBox()):
+            clipped = geom.intersection(QgsGeometry.fromRect(clip_rect))
+            if clipped is not None:
+                geom = clipped
+        return geom
+
+    def remove_layer(self, layer):
+        """ Remove all entries of the layer and stop watching it """
+        if layer not in self.layers:
+            return
+        for key in [key for key in self.entries if key[0] == layer]:
+            del self.entries[key]
+        self.layers.discard(layer)
+        layer.editingStopped.disconnect(self.on_editing_stopped)
+
+    def on_editing_stopped(self):
+        self.remove_layer(self.sender())
+
+    def on_layers_will_be_removed(self, layer_ids):
+        for layer in list(self.layers):
+            if layer.id() in layer_ids:
+                self.remove_layer(layer)
+
+    def _simplified_geometry(self, geom, tolerance):
+        if geom.geometry() is None:
+            return geom
+        if QgsWKBTypes.isCurvedType(geom.geometry().wkbType()):
+            geom = QgsGeometry(geom.geometry().segmentize())
+        if geom.type() == QGis.Line or geom.type() == QGis.Polygon:
+            simplified = geom.simplify(tolerance)
+            # tiny polygons may collapse - keep the original geometry then
+            if simplified is not None and not simplified.isEmpty():
+                geom = simplified
+        return geom
@@ -0,0 +1,177 @@
+#-----------------------------------------------------------
+# Copyright (C) 2015 Martin Dobias
+#-----------------------------------------------------------
+# Licensed under the terms of GNU GPL 2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#---------------------------------------------------------------------
+
+from collections import deque
+from functools import wraps
+import json
+import time
+
+from PyQt4.QtGui import *
+from PyQt4.QtCore import *
+
+
+SETTINGS_KEY = "/CadNodeTool/instrumentation"
+
+PERCENTILES = (50, 95, 99)
+
+
+class _NullStage(object):
+    """ Context manager that does nothing - used when instrumentation is disabled """
+    def __enter__(self):
+        pass
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage(object):
+    """ Context manager recording duration of one stage """
+    __slots__ = ("recorder", "name", "start")
+
+    def __init__(self, recorder, name):
+        self.recorder = recorder
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.recorder.record(self.name, time.time() - self.start)
+        return False
+
+
+class LatencyRecorder(object):
+    """ Rolling window of latencies of stages of the node tool's event handling
+    (whole canvas events, snapping, geometry fetches, highlight, edits...).
+    Enabled with QSettings key /CadNodeTool/instrumentation - when disabled,
+    stages are not timed at all. """
+
+    def __init__(self, window=1000):
+        self.window = window   # how many latest samples are kept for each stage
+        self.samples = {}      # { stage : deque of durations in seconds }
+        self.enabled = QSettings().value(SETTINGS_KEY, False, type=bool)
+
+    def set_enabled(self, enabled):
+        self.enabled = enabled
+        QSettings().setValue(SETTINGS_KEY, enabled)
+
+    def stage(self, name):
+        """ Return context manager that records duration of the enclosed block as the given stage """
+        if not self.enabled:
+            return _NULL_STAGE
+        return _Stage(self, name)
+
+    def record(self, name, duration):
+        """ Add sample (duration in seconds) of the given stage """
+        samples = self.samples.get(name)
+        if samples is None:
+            samples = self.samples[name] = deque(maxlen=self.window)
+        samples.append(duration)
+
+    def reset(self):
+        self.samples = {}
+
+    def report(self):
+        """ Return { stage : { "count", "p50", "p95", "p99", "max" } } with durations in milliseconds """
+        result = {}
+        for name, samples in self.samples.iteritems():
+            values = sorted(samples)
+            stats = {"count": len(values), "max": values[-1] * 1000}
+            for p in PERCENTILES:
+                stats["p%d" % p] = values[min(len(values) - 1, len(values) * p / 100)] * 1000
+            result[name] = stats
+        return result
+
+    def export(self, filename):
+        """ Write the report as JSON to a file """
+        with open(filename, "w") as f:
+            json.dump(self.report(), f, indent=2, sort_keys=True)
+
+
+def timed(stage):
+    """ Decorator of NodeTool methods: record duration of the method as the given stage """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(self, *args, **kwargs):
+            if not self.latency.enabled:
+                return func(self, *args, **kwargs)
+            with _Stage(self.latency, stage):
+                return func(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class LatencyDockWidget(QDockWidget):
+    """ Dock widget showing latency percentiles of all stages, with possibility to export them """
+
+    COLUMNS = ["Stage", "Count"] + ["p%d [ms]" % p for p in PERCENTILES] + ["max [ms]"]
+
+    def __init__(self, recorder, parent=None):
+        QDockWidget.__init__(self, "Node Tool Latency", parent)
+        self.setObjectName("CadNodeToolLatencyDock")
+        self.recorder = recorder
+
+        self.check_enabled = QCheckBox("Enabled")
+        self.check_enabled.setChecked(recorder.enabled)
+        self.check_enabled.toggled.connect(self.recorder.set_enabled)
+        btn_reset = QPushButton("Reset")
+        btn_reset.clicked.connect(self.on_reset)
+        btn_export = QPushButton("Export...")
+        btn_export.clicked.connect(self.on_export)
+
+        self.table = QTableWidget(0, len(self.COLUMNS))
+        self.table.setHorizontalHeaderLabels(self.COLUMNS)
+        self.table.verticalHeader().setVisible(False)
+        self.table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+
+        buttons = QHBoxLayout()
+        buttons.addWidget(self.check_enabled)
+        buttons.addStretch()
+        buttons.addWidget(btn_reset)
+        buttons.addWidget(btn_export)
+        layout = QVBoxLayout()
+        layout.addLayout(buttons)
+        layout.addWidget(self.table)
+        widget = QWidget()
+        widget.setLayout(layout)
+        self.setWidget(widget)
+
+        # refresh periodically, only while the dock is visible
+        self.timer = QTimer(self)
+        self.timer.setInterval(1000)
+        self.timer.timeout.connect(self.refresh)
+        self.visibilityChanged.connect(self.on_visibility_changed)
+
+    def on_visibility_changed(self, visible):
+        if visible:
+            self.refresh()
+            self.timer.start()
+        else:
+            self.timer.stop()
+
+    def refresh(self):
+        report = self.recorder.report()
+        self.table.setRowCount(len(report))
+        for row, name in enumerate(sorted(report.iterkeys())):
+            stats = report[name]
+            values = [name, str(stats["count"])] + ["%.1f" % stats["p%d" % p] for p in PERCENTILES] + ["%.1f" % stats["max"]]
+            for column, value in enumerate(values):
+                self.table.setItem(row, column, QTableWidgetItem(value))
+
+    def on_reset(self):
+        self.recorder.reset()
+        self.refresh()
+
+    def on_export(self):
+        filename = QFileDialog.getSaveFileName(self, "Export latencies", "", "JSON files (*.json)")
+        if filename:
+            self.recorder.export(filename)
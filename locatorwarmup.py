@@ -0,0 +1,159 @@
+#-----------------------------------------------------------
+# Copyright (C) 2015 Martin Dobias
+#-----------------------------------------------------------
+# Licensed under the terms of GNU GPL 2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#---------------------------------------------------------------------
+
+from PyQt4.QtCore import *
+
+from qgis.core import *
+
+
+DEFAULT_FEATURE_LIMIT = 100000
+
+# sizes of areas (relative to the visible extent) tried in turn for layers too large for a full index
+AREA_SCALES = (2., 1.)
+
+
+class LocatorWarmup(QObject):
+    """ Builds point locator indexes of snapping utils layer by layer from the event loop,
+    so they are ready before the first snap. QGIS builds the indexes only in the main thread,
+    so each step is bounded by the feature limit (QSettings key /CadNodeTool/locator_feature_limit):
+    layers with fewer features get a full index, larger layers get an index of the area around
+    the visible extent. The area is indexed again in a later step once the view moves out of it.
+    Until a layer has an index covering the view, snapping should use extent-limited temporary
+    locators for it - that only lasts if even the visible extent has more features than the limit
+    (until the view changes). """
+
+    progress = pyqtSignal(int, int)   # number of layers indexed, total number of queued layers
+    index_changed = pyqtSignal()      # a layer got its index - or its index does not cover the view anymore
+    finished = pyqtSignal()           # there are no more layers to index
+
+    def __init__(self, snap_utils, canvas, parent=None):
+        QObject.__init__(self, parent)
+        self.snap_utils = snap_utils
+        self.canvas = canvas
+        self.queue = []          # ids of layers waiting for their index
+        self.large = {}          # { layer id : index to AREA_SCALES of the next area to try } - layers indexed by areas
+        self.too_dense = set()   # ids of large layers with too many features even within the visible extent
+        self.watched = set()     # ids of layers with connected signals
+        self.feature_limit = QSettings().value("/CadNodeTool/locator_feature_limit", DEFAULT_FEATURE_LIMIT, type=int)
+        self.done = 0
+        self.total = 0
+
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(100)   # let the GUI repaint (e.g. the progress) between steps
+        self.timer.timeout.connect(self.index_next_layer)
+
+        canvas.extentsChanged.connect(self.on_extents_changed)
+        QgsMapLayerRegistry.instance().layersWillBeRemoved.connect(self.on_layers_will_be_removed)
+
+    def start(self, layers):
+        """ Queue layers whose locators do not have an index (covering the view) yet """
+        for layer in layers:
+            if layer.id() not in self.watched:
+                self.watched.add(layer.id())
+                layer.dataChanged.connect(self.on_layer_changed)
+                layer.editingStarted.connect(self.on_layer_changed)
+            if layer.id() not in self.too_dense and not self.has_index(layer):
+                self._queue(layer)
+
+    def _queue(self, layer):
+        if layer.id() not in self.queue:
+            self.queue.append(layer.id())
+            self.total += 1
+        if not self.timer.isActive():
+            self.progress.emit(self.done, self.total)
+            self.timer.start()
+
+    def has_index(self, layer):
+        """ Return whether the layer's locator has an index ready to be used within the visible extent """
+        locator = self.snap_utils.locatorForLayer(layer)
+        if not locator.hasIndex():
+            return False
+        extent = locator.extent()
+        return extent is None or extent.contains(self.canvas.extent())
+
+    def finish(self):
+        """ Index all queued layers right now (blocking) """
+        while len(self.queue) != 0:
+            self.index_next_layer()
+
+    def index_next_layer(self):
+        layer = QgsMapLayerRegistry.instance().mapLayer(self.queue.pop(0))
+        # the layer may have been removed or its editing stopped in the meanwhile
+        if isinstance(layer, QgsVectorLayer) and layer.isEditable() and not self.has_index(layer):
+            if not self._index_layer(layer):
+                self.queue.append(layer.id())   # try a smaller area in the next step
+                self.total += 1
+        self.done += 1
+        self.index_changed.emit()
+
+        if len(self.queue) != 0:
+            self.progress.emit(self.done, self.total)
+            self.timer.start()
+        else:
+            self.timer.stop()
+            self.done = self.total = 0
+            self.finished.emit()
+
+    def _index_layer(self, layer):
+        """ Do one bounded step of indexing of the layer - returns False if another step is needed """
+        locator = self.snap_utils.locatorForLayer(layer)
+        if layer.id() not in self.large:
+            if layer.featureCount() <= self.feature_limit:
+                locator.setExtent(None)
+                # init() gives up once it gets over the limit (the feature count may not be exact)
+                if locator.init(self.feature_limit):
+                    return True
+            self.large[layer.id()] = 0
+            return False
+
+        scale_index = self.large[layer.id()]
+        area = QgsRectangle(self.canvas.extent())
+        area.scale(AREA_SCALES[scale_index])
+        locator.setExtent(area)
+        if locator.init(self.feature_limit):
+            self.large[layer.id()] = 0   # start with the larger area again when the view moves
+            return True
+        if scale_index + 1 < len(AREA_SCALES):
+            self.large[layer.id()] = scale_index + 1
+            return False
+        # even the view has too many features - temporary locators are used until the view changes
+        self.large[layer.id()] = 0
+        self.too_dense.add(layer.id())
+        return True
+
+    def forget_layer(self, layer_id):
+        self.large.pop(layer_id, None)
+        self.too_dense.discard(layer_id)
+
+    def on_extents_changed(self):
+        if len(self.large) == 0:
+            return
+        self.too_dense.clear()
+        layers = [QgsMapLayerRegistry.instance().mapLayer(layer_id) for layer_id in self.large]
+        layers = [layer for layer in layers if isinstance(layer, QgsVectorLayer) and layer.isEditable()]
+        if any(not self.has_index(layer) for layer in layers):
+            self.index_changed.emit()   # snapping should use temporary locators for them meanwhile
+            self.start(layers)
+
+    def on_layer_changed(self):
+        # reloaded data or editing started again - start from scratch. The layer is queued
+        # without checking its index: the locator may drop it only after this slot
+        layer = self.sender()
+        self.forget_layer(layer.id())
+        if layer.isEditable():
+            self.index_changed.emit()
+            self._queue(layer)
+
+    def on_layers_will_be_removed(self, layer_ids):
+        for layer_id in layer_ids:
+            self.forget_layer(layer_id)
+            self.watched.discard(layer_id)
@@ -0,0 +1,77 @@
+#-----------------------------------------------------------
+# Copyright (C) 2015 Martin Dobias
+#-----------------------------------------------------------
+# Licensed under the terms of GNU GPL 2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#---------------------------------------------------------------------
+
+from PyQt4.QtCore import *
+
+from qgis.core import *
+
+from geomutils import vertex_coordinates, vertex_indices_in_rect, take_coordinates
+
+
+class NodeSelectionThread(QThread):
+    """ Finds vertices of features within a rectangle in a background thread.
+    It reads feature sources (snapshots of layers) so layers can be used in the GUI thread
+    in the meanwhile. Found vertices are sent in chunks so the selection can be shown progressively.
+    Coordinates are sent in layer CRS - transforms are not used outside of the GUI thread. """
+
+    CHUNK_SIZE = 5000   # how many vertices to collect before sending them
+
+    nodes_found = pyqtSignal(object)   # list of tuples (layer, fid, list of vertex ids, xs, ys)
+    progress = pyqtSignal(int)         # estimated percentage of work done
+
+    def __init__(self, layer_sources, parent=None):
+        """ layer_sources is a list of tuples (layer, feature source, QgsRectangle in layer CRS) """
+        QThread.__init__(self, parent)
+        self.layer_sources = layer_sources
+        self.estimates = [self._estimate_feature_count(layer, rect) for layer, _, rect in layer_sources]
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def run(self):
+        total = max(1, sum(self.estimates))
+        done = 0
+        last_percent = -1
+        chunk, chunk_size = [], 0
+
+        for layer, source, rect in self.layer_sources:
+            request = QgsFeatureRequest(rect).setSubsetOfAttributes([])
+            for f in source.getFeatures(request):
+                if self.cancelled:
+                    return
+
+                xs, ys = vertex_coordinates(f.geometry())
+                vertex_ids = vertex_indices_in_rect(xs, ys, rect)
+                if len(vertex_ids) != 0:
+                    sel_xs, sel_ys = take_coordinates(xs, ys, vertex_ids)
+                    chunk.append((layer, f.id(), vertex_ids, sel_xs, sel_ys))
+                    chunk_size += len(vertex_ids)
+                    if chunk_size >= self.CHUNK_SIZE:
+                        self.nodes_found.emit(chunk)
+                        chunk, chunk_size = [], 0
+
+                done += 1
+                percent = min(99, done * 100 / total)   # the count is just an estimate
+                if percent != last_percent:
+                    self.progress.emit(percent)
+                    last_percent = percent
+
+        if len(chunk) != 0 and not self.cancelled:
+            self.nodes_found.emit(chunk)
+
+    def _estimate_feature_count(self, layer, rect):
+        """ Guess how many features are within the rectangle (assuming they are spread evenly) """
+        extent = layer.extent()
+        if extent.isEmpty():
+            return layer.featureCount()
+        fraction = extent.intersect(rect).area() / extent.area()
+        return int(layer.featureCount() * min(1., fraction)) + 1
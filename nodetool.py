@@ -9,7 +9,8 @@
 # (at your option) any later version.
 #---------------------------------------------------------------------
 
-import math
+from array import array
+from bisect import bisect_right
 
 from PyQt4.QtGui import *
 from PyQt4.QtCore import *
@@ -17,7 +18,19 @@ from PyQt4.QtCore import *
 from qgis.core import *
 from qgis.gui import *
 
-from geomutils import is_endpoint_at_vertex_index, vertex_at_vertex_index, adjacent_vertex_index_to_endpoint, vertex_index_to_tuple
+from geomutils import vertex_at_vertex_index, adjacent_vertex_index_to_endpoint, \
+    take_coordinates, vertex_coordinates, vertex_indices_in_polygon, concatenate_coordinates
+from geomkernel import sqr_dist, visible_midpoint, extend_from_endpoint
+from geometrycache import GeometryCache
+from topology import NodeTopology
+from highlight import HighlightGeometryCache
+from canvasitems import NodeMarkersItem, DragPreviewItem
+from editapplier import EditApplier
+from requeststats import RequestStats, HOVER, DRAG_START, DROP, DELETE, RECT_SELECT, POLYGON_SELECT
+from transforms import TransformService
+from instrumentation import LatencyRecorder, timed
+from nodeselection import NodeSelectionThread
+from locatorwarmup import LocatorWarmup
 
 
 class Vertex(object):
@@ -32,6 +45,11 @@ class Edge(object):
         self.fid = fid
         self.edge_vertex_0 = vertex_id   # first vertex (with lower index)
         self.start_map_point = start_map_point  # map point where edge drag started
+        # vertices moved by the drag (this edge or all selected edges) and their original
+        # map coordinates - indices are the same as of moving points in the drag preview
+        self.vertices = []    # list of Vertex instances
+        self.map_xs = array('d')
+        self.map_ys = array('d')
 
 
 class OneFeatureFilter(QgsPointLocator.MatchFilter):
@@ -55,35 +73,18 @@ def _digitizing_color_width():
     return color, width
 
 
-def _is_circular_vertex(geom, vertex_index):
-    """Find out whether geom (QgsGeometry) has a circular vertex on the given index"""
-    if geom.type() != QGis.Line and geom.type() != QGis.Polygon:
-        return False
-    v_id = QgsVertexId()
-    res = geom.vertexIdFromVertexNr(vertex_index, v_id)
-
-    # we need to get vertex type in this painful way because the above function
-    # does not actually set "type" attribute (surprise surprise)
-    g = geom.geometry()
-    if isinstance(g, QgsGeometryCollectionV2):
-        g = g.geometryN(v_id.part)
-    if isinstance(g, QgsCurvePolygonV2):
-        g = g.exteriorRing() if v_id.ring == 0 else g.interiorRing(v_id.ring - 1)
-    assert isinstance(g, QgsCurveV2)
-    p = QgsPointV2()
-    res, v_type = g.pointAt(v_id.vertex, p)
-    if not res:
-        return False
-    return v_type == QgsVertexId.CurveVertex
-
-
-
+class NodeTool(QgsMapToolAdvancedDigitizing):
 
+    selection_progress = pyqtSignal(int)   # percentage of selection of nodes running in background
+    selection_finished = pyqtSignal()      # selection of nodes in background is finished or cancelled
+    highlighted_nodes_changed = pyqtSignal()   # selected_nodes have been replaced or extended
 
-class NodeTool(QgsMapToolAdvancedDigitizing):
     def __init__(self, canvas, cadDock):
         QgsMapToolAdvancedDigitizing.__init__(self, canvas, cadDock)
 
+        # optional timing of stages of event handling (see LatencyDockWidget)
+        self.latency = LatencyRecorder()
+
         self.snap_marker = QgsVertexMarker(canvas)
         self.snap_marker.setIconType(QgsVertexMarker.ICON_CROSS)
         self.snap_marker.setColor(Qt.magenta)
@@ -97,7 +98,7 @@ class NodeTool(QgsMapToolAdvancedDigitizing):
         self.edge_center_marker.setVisible(False)
 
         # used only for moving standalone points
-        # (there are no adjacent vertices so self.drag_bands is empty in that case)
+        # (there are no adjacent vertices so self.drag_preview is empty in that case)
         self.drag_point_marker = QgsVertexMarker(canvas)
         self.drag_point_marker.setIconType(QgsVertexMarker.ICON_X)
         self.drag_point_marker.setColor(Qt.red)
@@ -112,6 +113,8 @@ class NodeTool(QgsMapToolAdvancedDigitizing):
         self.feature_band.setWidth(5)
         self.feature_band.setVisible(False)
         self.feature_band_source = None   # tuple (layer, fid) or None depending on what is being shown
+        self.highlight_cache = HighlightGeometryCache(self)
+        canvas.extentsChanged.connect(self.on_extents_changed)
 
         self.vertex_band = QgsRubberBand(self.canvas())
         self.vertex_band.setIcon(QgsRubberBand.ICON_CIRCLE)
@@ -126,19 +129,28 @@ class NodeTool(QgsMapToolAdvancedDigitizing):
         self.edge_band.setWidth(10)
         self.edge_band.setVisible(False)
 
-        self.drag_bands = []        # list of QgsRubberBand instances used when dragging
+        # segments adjacent to the dragged vertex or edge (style is refreshed on activation)
+        self.drag_preview = DragPreviewItem(canvas)
+        self.drag_preview.set_style(color, width)
+
         self.dragging = None        # instance of Vertex that is being currently moved or nothing
                                     # (vertex_id when adding is a tuple (vid, adding_at_endpoint))
         self.dragging_topo = []     # list of Vertex instances of other vertices that are topologically
                                     # connected to the vertex being currently dragged
         self.dragging_edge = None   # instance of Edge that is being currently moved or nothing
-        self.dragging_edge_bands = None  # tuple (band_0_1, bands_to_0, bands_to_1) with rubberbands when moving edge
         self.selected_nodes = []    # list of Vertex instances of nodes that are selected
-        self.selected_nodes_markers = []  # list of vertex markers
+        self.selected_node_keys = set()  # tuples (layer, fid, vertex id) of selected_nodes - for quick lookups
+        self.selected_nodes_item = NodeMarkersItem(canvas)  # canvas item with markers of selected nodes
 
         self.dragging_rect_start_pos = None    # QPoint if user is dragging a selection rect
         self.selection_rect = None       # QRect in screen coordinates
         self.selection_rect_item = None  # QRubberBand to show selection_rect
+        self.node_selection = None       # NodeSelectionThread collecting selected nodes in background (or None)
+        self.cancelled_node_selections = []  # cancelled threads that may still be running (until the current feature is done)
+        self.delete_after_selection = False  # whether to delete the selected nodes once node_selection is finished
+        self.selection_polygon = None    # list of QgsPoint (map coordinates) of lasso or polygon being drawn (or None)
+        self.selection_polygon_lasso = False  # whether drawing freehand lasso (Alt+drag) or polygon (Shift+clicks)
+        self.selection_polygon_band = None    # QgsRubberBand to show selection_polygon
 
         self.mouse_at_endpoint = None   # Vertex instance or None
         self.endpoint_marker_center = None  # QgsPoint or None (can't get center from QgsVertexMarker)
@@ -149,12 +161,47 @@ class NodeTool(QgsMapToolAdvancedDigitizing):
         self.endpoint_marker.setVisible(False)
 
         self.last_snap = None   # Match or None - to stick with previously highlighted feature
+        self.hover_snap = None  # tuple (QPoint, Match) of the last hover - reused by a press at the same position
+        canvas.renderStarting.connect(self.on_render_starting)
 
         self.override_cad_points = None  # list of QgsPoint or None
 
         self.new_vertex_from_double_click = None  # Match or None
 
-        self.cache = {}
+        self.last_edit_timings = {}   # durations of phases of the last applied edit (see EditApplier)
+
+        # cached conversions of coordinates between layers and map
+        self.transforms = TransformService(canvas, self)
+
+        # accounting of feature requests - all requests to layers should go through it
+        self.request_stats = RequestStats()
+
+        self.cache = GeometryCache(self.request_stats, self)
+
+        # vertices of editable layers indexed by their coordinates (for topological editing)
+        self.topology = NodeTopology(self.cache, self.request_stats, self)
+
+        # snapping utils used just by the node tool: snapping to vertices and edges of all
+        # editable layers. The global snapping configuration is not touched at all and the
+        # layer configuration is updated only if layers, their editability or tolerance change
+        self.snap_utils = QgsMapCanvasSnappingUtils(canvas, self)
+        self.snap_utils.setSnapToMapMode(QgsSnappingUtils.SnapAdvanced)
+        self.snap_utils.setSnapOnIntersections(False)  # only snap to layers
+        self.snap_layers_dirty = True      # whether the layer configuration needs to be updated
+        self.snap_layers_tolerance = None  # tolerance used for the current layer configuration
+        self.snap_watched_layers = []      # vector layers of canvas with connected editing signals
+        canvas.layersChanged.connect(self.on_snap_layers_changed)
+        canvas.destinationCrsChanged.connect(self.on_snap_layers_changed)  # locators get cleared
+
+        # building of locator indexes ahead of snapping - snap_utils only get layers with an index
+        # covering the view. Other layers (waiting for the index) are snapped with temp_snap_utils
+        # that never build an index, just temporary locators of the area around the snapped point
+        self.locator_warmup = LocatorWarmup(self.snap_utils, canvas, self)
+        self.locator_warmup.index_changed.connect(self.on_snap_layers_changed)
+        self.temp_snap_utils = QgsMapCanvasSnappingUtils(canvas, self)
+        self.temp_snap_utils.setSnapToMapMode(QgsSnappingUtils.SnapAdvanced)
+        self.temp_snap_utils.setSnapOnIntersections(False)
+        self.temp_snap_utils.setIndexingStrategy(QgsSnappingUtils.IndexNeverFull)
 
     def __del__(self):
         """ Cleanup canvas items we have created """
@@ -165,6 +212,8 @@ class NodeTool(QgsMapToolAdvancedDigitizing):
         self.canvas().scene().removeItem(self.vertex_band)
         self.canvas().scene().removeItem(self.edge_band)
         self.canvas().scene().removeItem(self.endpoint_marker)
+        self.canvas().scene().removeItem(self.selected_nodes_item)
+        self.canvas().scene().removeItem(self.drag_preview)
         self.snap_marker = None
         self.edge_center_marker = None
         self.drag_point_marker = None
@@ -172,8 +221,24 @@ class NodeTool(QgsMapToolAdvancedDigitizing):
         self.vertex_band = None
         self.edge_band = None
         self.endpoint_marker = None
+        self.selected_nodes_item = None
+        self.drag_preview = None
+
+    def activate(self):
+        # read the digitizing style just once - not for every drag
+        color, width = _digitizing_color_width()
+        self.drag_preview.set_style(color, width)
+        self.start_locator_warmup()
+        QgsMapToolAdvancedDigitizing.activate(self)
 
     def deactivate(self):
+        self.hover_snap = None
+        self.cancel_node_selection()
+        # the threads are our children - they must not be running when the tool gets deleted (e.g. on unload)
+        for thread in self.cancelled_node_selections:
+            thread.wait()
+        if self.selection_polygon is not None:
+            self.stop_selection_polygon()
         self.set_highlighted_nodes([])
         self.remove_temporary_rubber_bands()
         QgsMapToolAdvancedDigitizing.deactivate(self)
@@ -198,46 +263,52 @@ class NodeTool(QgsMapToolAdvancedDigitizing):
     def topo_editing(self):
         return QgsProject.instance().readNumEntry("Digitizing", "/TopologicalEditing", 0)[0]
 
-    def add_drag_band(self, v1, v2):
-        drag_band = QgsRubberBand(self.canvas())
-
-        color, width = _digitizing_color_width()
-
-        drag_band.setColor(color)
-        drag_band.setWidth(width)
-        drag_band.addPoint(v1)
-        drag_band.addPoint(v2)
-        self.drag_bands.append(drag_band)
-
-    def clear_drag_bands(self):
-        for band in self.drag_bands:
-            self.canvas().scene().removeItem(band)
-        self.drag_bands = []
+    def clear_drag_preview(self):
+        self.drag_preview.clear()
 
         # for the case when standalone point geometry is being dragged
         self.drag_point_marker.setVisible(False)
 
+    @timed("press")
     def cadCanvasPressEvent(self, e):
 
         if not self.can_use_current_layer():
             return
 
-        self.set_highlighted_nodes([])   # reset selection
+        # stop selection running in background (if any) - the user may be starting a new one
+        self.cancel_node_selection()
+
+        # reset selection - unless the user is about to drag one of the selected edges
+        if not self.dragging and not self.dragging_edge and len(self.selected_nodes) >= 2 and \
+                e.button() == Qt.LeftButton and not e.modifiers() & (Qt.ControlModifier | Qt.AltModifier | Qt.ShiftModifier):
+            m = self.snap_from_hover(e)
+            if not m.hasEdge() or not self.is_selected_edge(m):
+                self.set_highlighted_nodes([])
+        else:
+            self.set_highlighted_nodes([])
 
         if e.button() == Qt.LeftButton:
 
             # Ctrl+Click to highlight nodes without entering editing mode
             if e.modifiers() & Qt.ControlModifier:
-                m = self.snap_to_editable_layer(e)
+                m = self.snap_from_hover(e)
                 if m.hasVertex():
                     node = Vertex(m.layer(), m.featureId(), m.vertexIndex())
                     self.set_highlighted_nodes([node])
                 return
 
+            if self.selection_polygon is not None or e.modifiers() & Qt.ShiftModifier:
+                return  # polygon selection is handled on release
+
             if not self.dragging and not self.dragging_edge:
-                # the user may have started dragging a rect to select vertices
-                self.dragging_rect_start_pos = e.pos()
+                if e.modifiers() & Qt.AltModifier:
+                    # Alt+drag to select vertices within a freehand lasso
+                    self.start_selection_polygon(self.toMapCoordinates(e.pos()), True)
+                else:
+                    # the user may have started dragging a rect to select vertices
+                    self.dragging_rect_start_pos = e.pos()
 
+    @timed("release")
     def cadCanvasReleaseEvent(self, e):
 
         if not self.can_use_current_layer():
@@ -254,37 +325,35 @@ class NodeTool(QgsMapToolAdvancedDigitizing):
 
         elif self.selection_rect is not None:
             # only handling of selection rect being dragged
-            pt0 = self.toMapCoordinates(self.dragging_rect_start_pos)
-            pt1 = self.toMapCoordinates(e.pos())
-            map_rect = QgsRectangle(pt0, pt1)
-            nodes = []
-
-            # for each editable layer, select nodes
-            for layer in self.canvas().layers():
-                if not isinstance(layer, QgsVectorLayer) or not layer.isEditable():
-                    continue
-                layer_rect = self.toLayerCoordinates(layer, map_rect)
-                for f in layer.getFeatures(QgsFeatureRequest(layer_rect)):
-                    g = f.geometry()
-                    for i in xrange(g.geometry().nCoordinates()):
-                        pt = g.vertexAt(i)
-                        if layer_rect.contains(pt):
-                            nodes.append( Vertex(layer, f.id(), i) )
-
-            self.set_highlighted_nodes(nodes)
+            with self.request_stats.interaction(RECT_SELECT):
+                self.select_nodes_in_rect(e)
 
             self.stop_selection_rect()
 
+        elif self.selection_polygon is not None:
+            if self.selection_polygon_lasso or e.button() == Qt.RightButton:
+                self.finish_selection_polygon()
+            elif e.button() == Qt.LeftButton:
+                self.add_selection_polygon_point(self.toMapCoordinates(e.pos()))
+
+        elif e.button() == Qt.LeftButton and e.modifiers() & Qt.ShiftModifier and \
+                not self.dragging and not self.dragging_edge:
+            # Shift+click to start selection of vertices within a polygon (right click to finish it)
+            self.start_selection_polygon(self.toMapCoordinates(e.pos()), False)
+
         else:  # selection rect is not being dragged
             if e.button() == Qt.LeftButton:
                 # accepting action
                 if self.dragging:
-                    self.move_vertex(e.mapPoint(), e.mapPointMatch())
+                    with self.request_stats.interaction(DROP):
+                        self.move_vertex(e.mapPoint(), e.mapPointMatch())
                 elif self.dragging_edge:
                     map_point = self.toMapCoordinates(e.pos())  # do not use e.mapPoint() as it may be snapped
-                    self.move_edge(map_point)
+                    with self.request_stats.interaction(DROP):
+                        self.move_edge(map_point)
                 else:
-                    self.start_dragging(e)
+                    with self.request_stats.interaction(DRAG_START):
+                        self.start_dragging(e)
             elif e.button() == Qt.RightButton:
                 # cancelling action
                 self.stop_dragging()
@@ -302,6 +371,76 @@ class NodeTool(QgsMapToolAdvancedDigitizing):
                 self.cadDockWidget().canvasReleaseEvent(me, True)
             self.override_cad_points = None
 
+    @timed("rect_select")
+    def select_nodes_in_rect(self, e):
+        """ Start selection of nodes of editable layers within the selection rect that has been dragged.
+        Features are searched in a background thread and the found nodes are added to the selection
+        as they arrive (see on_node_selection_found) """
+        self.cancel_node_selection()
+
+        pt0 = self.toMapCoordinates(self.dragging_rect_start_pos)
+        pt1 = self.toMapCoordinates(e.pos())
+        map_rect = QgsRectangle(pt0, pt1)
+
+        layer_sources = []
+        for layer in self.canvas().layers():
+            if not isinstance(layer, QgsVectorLayer) or not layer.isEditable():
+                continue
+            layer_rect = self.transforms.to_layer_rect(layer, map_rect)
+            layer_sources.append((layer, self.request_stats.feature_source(layer), layer_rect))
+
+        self.set_highlighted_nodes([])
+
+        self.node_selection = NodeSelectionThread(layer_sources, self)
+        self.node_selection.nodes_found.connect(self.on_node_selection_found)
+        self.node_selection.progress.connect(self.selection_progress)
+        self.node_selection.finished.connect(self.on_node_selection_finished)
+        self.node_selection.finished.connect(self.node_selection.deleteLater)
+        self.node_selection.start()
+
+    def on_node_selection_found(self, chunk):
+        if self.sender() is not self.node_selection:
+            return  # a late chunk from a cancelled selection
+        for layer, fid, vertex_ids, xs, ys in chunk:
+            self.add_highlighted_nodes(layer, fid, vertex_ids, xs, ys)
+
+    def on_node_selection_finished(self):
+        if self.sender() is not self.node_selection:
+            return
+        self.node_selection = None
+        self.selection_finished.emit()
+
+        if self.delete_after_selection:
+            self.delete_after_selection = False
+            with self.request_stats.interaction(DELETE):
+                self.delete_vertex()
+
+    def cancel_node_selection(self):
+        """ Stop selection of nodes running in background - the nodes found so far stay selected """
+        self.delete_after_selection = False
+        if self.node_selection is None:
+            return
+        # nothing more from the thread should reach the selection or the progress shown to the user
+        self.node_selection.nodes_found.disconnect(self.on_node_selection_found)
+        self.node_selection.progress.disconnect(self.selection_progress)
+        self.node_selection.cancel()
+        self.cancelled_node_selections.append(self.node_selection)
+        self.node_selection.finished.connect(self.on_cancelled_node_selection_finished)
+        self.node_selection = None
+        self.selection_finished.emit()
+
+    def on_cancelled_node_selection_finished(self):
+        self.cancelled_node_selections.remove(self.sender())
+
+    def wait_for_node_selection(self):
+        """ Block until selection of nodes running in background is finished and all nodes are selected.
+        Only meant for scripts and benchmarks - it must not be called from event handlers """
+        if self.node_selection is None:
+            return
+        self.node_selection.wait()
+        QCoreApplication.processEvents()   # deliver queued chunks
+
+    @timed("move")
     def cadCanvasMoveEvent(self, e):
 
         if not isinstance(e, QgsMapMouseEvent):
@@ -316,6 +455,8 @@ class NodeTool(QgsMapToolAdvancedDigitizing):
             self.mouse_move_dragging(e)
         elif self.dragging_edge:
             self.mouse_move_dragging_edge(e)
+        elif self.selection_polygon is not None:
+            self.update_selection_polygon(self.toMapCoordinates(e.pos()))
         elif self.dragging_rect_start_pos:
             # the user may be dragging a rect to select vertices
             if self.selection_rect is None and \
@@ -324,7 +465,8 @@ class NodeTool(QgsMapToolAdvancedDigitizing):
             if self.selection_rect is not None:
                 self.update_selection_rect(e.pos())
         else:
-            self.mouse_move_not_dragging(e)
+            with self.request_stats.interaction(HOVER):
+                self.mouse_move_not_dragging(e)
 
 
     def mouse_move_dragging(self, e):
@@ -336,8 +478,8 @@ class NodeTool(QgsMapToolAdvancedDigitizing):
 
         self.edge_center_marker.setVisible(False)
 
-        for band in self.drag_bands:
-            band.movePoint(1, e.mapPoint())
+        if self.drag_preview.moving_count() != 0:
+            self.drag_preview.set_moving_point(0, e.mapPoint())
 
         # in case of moving of standalone point geometry
         if self.drag_point_marker.isVisible():
@@ -351,35 +493,20 @@ class NodeTool(QgsMapToolAdvancedDigitizing):
         self.snap_marker.setVisible(False)
         self.edge_center_marker.setVisible(False)
 
-        band_0_1, bands_to_0, bands_to_1 = self.dragging_edge_bands
-        drag_layer = self.dragging_edge.layer
-        drag_fid = self.dragging_edge.fid
-        drag_vertex_0 = self.dragging_edge.edge_vertex_0
         drag_start_point = self.dragging_edge.start_map_point
         map_point = self.toMapCoordinates(e.pos())  # do not use e.mapPoint() as it may be snapped
 
-        diff_x, diff_y = map_point.x() - drag_start_point.x(), map_point.y() - drag_start_point.y()
-
-        geom = QgsGeometry(self.cached_geometry(drag_layer, drag_fid))
-        orig_map_point_0 = self.toMapCoordinates(drag_layer, geom.vertexAt(drag_vertex_0))
-        new_map_point_0 = QgsPoint(orig_map_point_0.x() + diff_x, orig_map_point_0.y() + diff_y)
-        orig_map_point_1 = self.toMapCoordinates(drag_layer, geom.vertexAt(drag_vertex_0+1))
-        new_map_point_1 = QgsPoint(orig_map_point_1.x() + diff_x, orig_map_point_1.y() + diff_y)
-
-        band_0_1.movePoint(0, new_map_point_0)
-        band_0_1.movePoint(1, new_map_point_1)
-
-        for band in bands_to_0:
-            band.movePoint(1, new_map_point_0)
-
-        for band in bands_to_1:
-            band.movePoint(1, new_map_point_1)
+        # everything else has been prepared when the drag started
+        self.drag_preview.set_moving_offset(map_point.x() - drag_start_point.x(), map_point.y() - drag_start_point.y())
 
         # make sure the temporary feature rubber band is not visible
         self.remove_temporary_rubber_bands()
 
     def canvasDoubleClickEvent(self, e):
         """ Start addition of a new vertex on double-click """
+        if self.selection_polygon is not None:
+            return
+
         m = self.snap_to_editable_layer(e)
         if not m.isValid():
             return
@@ -394,62 +521,120 @@ class NodeTool(QgsMapToolAdvancedDigitizing):
         self.endpoint_marker_center = None
         self.endpoint_marker.setVisible(False)
 
+    def on_snap_layers_changed(self):
+        """ Called when the set of canvas layers or editability of a layer have changed """
+        self.snap_layers_dirty = True
+
+    def start_locator_warmup(self):
+        """ Start building point locator indexes of editable layers before they are needed for snapping """
+        self.locator_warmup.start([layer for layer in self.canvas().layers()
+                                   if isinstance(layer, QgsVectorLayer) and layer.isEditable()])
+
+    def update_snap_layers(self, tol):
+        """ Set up our snapping utils to snap to vertices and edges of any editable vector layer.
+        Layers without a locator index covering the view are snapped with temporary locators meanwhile """
+
+        for layer in self.snap_watched_layers:
+            try:
+                layer.editingStarted.disconnect(self.on_snap_layers_changed)
+                layer.editingStopped.disconnect(self.on_snap_layers_changed)
+            except RuntimeError:
+                pass   # the layer has been deleted in the meanwhile
+        self.snap_watched_layers = []
+
+        snap_type = QgsPointLocator.Type(QgsPointLocator.Vertex|QgsPointLocator.Edge)
+        snap_layers, temp_snap_layers = [], []
+        for layer in self.canvas().layers():
+            if not isinstance(layer, QgsVectorLayer):
+                continue
+            layer.editingStarted.connect(self.on_snap_layers_changed)
+            layer.editingStopped.connect(self.on_snap_layers_changed)
+            self.snap_watched_layers.append(layer)
+            if not layer.isEditable():
+                continue
+            self.locator_warmup.start([layer])
+            config = QgsSnappingUtils.LayerConfig(layer, snap_type, tol, QgsTolerance.ProjectUnits)
+            if self.locator_warmup.has_index(layer):
+                snap_layers.append(config)
+            else:
+                temp_snap_layers.append(config)
+
+        self.snap_utils.setLayers(snap_layers)
+        self.temp_snap_utils.setLayers(temp_snap_layers)
+        self.snap_layers_tolerance = tol
+        self.snap_layers_dirty = False
+
+    @timed("snap")
     def snap_to_editable_layer(self, e):
-        """ Temporarily override snapping config and snap to vertices and edges
-         of any editable vector layer, to allow selection of node for editing
-         (if snapped to edge, it would offer creation of a new vertex there).
+        """ Snap to vertices and edges of any editable vector layer, to allow selection
+         of node for editing (if snapped to edge, it would offer creation of a new vertex there).
         """
 
         map_point = self.toMapCoordinates(e.pos())
         tol = QgsTolerance.vertexSearchRadius(self.canvas().mapSettings())
-        snap_type = QgsPointLocator.Type(QgsPointLocator.Vertex|QgsPointLocator.Edge)
+        if self.snap_layers_dirty or tol != self.snap_layers_tolerance:
+            self.update_snap_layers(tol)
 
-        snap_layers = []
-        for layer in self.canvas().layers():
-            if not isinstance(layer, QgsVectorLayer) or not layer.isEditable():
-                continue
-            snap_layers.append(QgsSnappingUtils.LayerConfig(
-                layer, snap_type, tol, QgsTolerance.ProjectUnits))
-
-        snap_util = self.canvas().snappingUtils()
-        old_layers = snap_util.layers()
-        old_mode = snap_util.snapToMapMode()
-        old_intersections = snap_util.snapOnIntersections()
-        snap_util.setLayers(snap_layers)
-        snap_util.setSnapToMapMode(QgsSnappingUtils.SnapAdvanced)
-        snap_util.setSnapOnIntersections(False)  # only snap to layers
-        m = snap_util.snapToMap(map_point)
+        m = self._snap_to_map(map_point)
 
         # try to stay snapped to previously used feature
         # so the highlight does not jump around at nodes where features are joined
-        if self.last_snap is not None:
+        if self.last_snap is not None and self.last_snap.isValid() and \
+                (m.layer() != self.last_snap.layer() or m.featureId() != self.last_snap.featureId()):
             filter_last = OneFeatureFilter(self.last_snap.layer(), self.last_snap.featureId())
-            m_last = snap_util.snapToMap(map_point, filter_last)
+            m_last = self._snap_to_map(map_point, filter_last, self.last_snap.layer())
             if m_last.isValid() and m_last.distance() <= m.distance():
                 m = m_last
 
-        snap_util.setLayers(old_layers)
-        snap_util.setSnapToMapMode(old_mode)
-        snap_util.setSnapOnIntersections(old_intersections)
-
         self.last_snap = m
 
         return m
 
+    def snap_from_hover(self, e):
+        """ Return the match of the last hover if it happened at the same position - the layers have not
+        been rendered since, so nothing has changed (edits and extent changes make the canvas render).
+        Otherwise snap again """
+        if self.hover_snap is not None and self.hover_snap[0] == e.pos() and not self.snap_layers_dirty:
+            return self.hover_snap[1]
+        return self.snap_to_editable_layer(e)
+
+    def on_render_starting(self):
+        self.hover_snap = None
+
+    def _snap_to_map(self, map_point, match_filter=None, layer=None):
+        """ Snap with both snapping utils (layers with and without index) - return the closer match.
+        If the layer is given, only the snapping utils that have the layer are used """
+        temp_layers = [config.layer for config in self.temp_snap_utils.layers()]
+        temp_layer_ids = set(temp_layer.id() for temp_layer in temp_layers)
+        if layer is None or layer.id() not in temp_layer_ids:
+            m = self.snap_utils.snapToMap(map_point, match_filter)
+            if layer is not None or len(temp_layers) == 0:
+                return m
+        else:
+            m = QgsPointLocator.Match()
+        # each snap creates new temporary locators - one request per layer
+        for temp_layer in temp_layers:
+            self.request_stats.count_temp_locator(temp_layer)
+        m_temp = self.temp_snap_utils.snapToMap(map_point, match_filter)
+        if m_temp.isValid() and (not m.isValid() or m_temp.distance() < m.distance()):
+            return m_temp
+        return m
+
     def is_near_endpoint_marker(self, map_point):
         """check whether we are still close to the self.endpoint_marker"""
         if self.endpoint_marker_center is None:
             return False
 
-        dist_marker = math.sqrt(self.endpoint_marker_center.sqrDist(map_point))
+        x, y = map_point.x(), map_point.y()
+        center = self.endpoint_marker_center
+        sqr_dist_marker = sqr_dist(center.x(), center.y(), x, y)
         tol = QgsTolerance.vertexSearchRadius(self.canvas().mapSettings())
 
-        geom = self.cached_geometry_for_vertex(self.mouse_at_endpoint)
-        vertex_point_v2 = vertex_at_vertex_index(geom, self.mouse_at_endpoint.vertex_id)
-        vertex_point = QgsPoint(vertex_point_v2.x(), vertex_point_v2.y())
-        dist_vertex = math.sqrt(vertex_point.sqrDist(map_point))
+        xs, ys = self.cached_vertex_coordinates(self.mouse_at_endpoint.layer, self.mouse_at_endpoint.fid)
+        vertex_id = self.mouse_at_endpoint.vertex_id
+        sqr_dist_vertex = sqr_dist(xs[vertex_id], ys[vertex_id], x, y)
 
-        return dist_marker < tol and dist_marker < dist_vertex
+        return sqr_dist_marker < tol * tol and sqr_dist_marker < sqr_dist_vertex
 
     def is_match_at_endpoint(self, match):
         geom = self.cached_geometry(match.layer(), match.featureId())
@@ -457,20 +642,18 @@ class NodeTool(QgsMapToolAdvancedDigitizing):
         if geom.type() != QGis.Line:
             return False
 
-        return is_endpoint_at_vertex_index(geom, match.vertexIndex())
+        metadata = self.cached_vertex_metadata(match.layer(), match.featureId())
+        return metadata.endpoint[match.vertexIndex()] == 1
 
 
     def position_for_endpoint_marker(self, match):
-        geom = self.cached_geometry(match.layer(), match.featureId())
+        metadata = self.cached_vertex_metadata(match.layer(), match.featureId())
+        xs, ys = self.cached_vertex_coordinates(match.layer(), match.featureId())
 
-        pt0 = vertex_at_vertex_index(geom, adjacent_vertex_index_to_endpoint(geom, match.vertexIndex()))
-        pt1 = vertex_at_vertex_index(geom, match.vertexIndex())
-        dx = pt1.x() - pt0.x()
-        dy = pt1.y() - pt0.y()
+        index1 = match.vertexIndex()
+        index0 = metadata.next[index1] if metadata.prev[index1] == -1 else metadata.prev[index1]
         dist = 15 * self.canvas().mapSettings().mapUnitsPerPixel()
-        angle = math.atan2(dy, dx)  # to the top: angle=0, to the right: angle=90, to the left: angle=-90
-        x = pt1.x() + math.cos(angle)*dist
-        y = pt1.y() + math.sin(angle)*dist
+        x, y = extend_from_endpoint(xs[index0], ys[index0], xs[index1], ys[index1], dist)
         return QgsPoint(x, y)
 
     def mouse_move_not_dragging(self, e):
@@ -488,15 +671,16 @@ class NodeTool(QgsMapToolAdvancedDigitizing):
 
         # do not use snap from mouse event, use our own with any editable layer
         m = self.snap_to_editable_layer(e)
+        self.hover_snap = (QPoint(e.pos()), m)
 
         # possibility to move a node
         if m.type() == QgsPointLocator.Vertex:
             self.vertex_band.setToGeometry(QgsGeometry.fromPoint(m.point()), None)
             self.vertex_band.setVisible(True)
             is_circular_vertex = False
-            if m.layer:
-                geom = self.cached_geometry(m.layer(), m.featureId())
-                is_circular_vertex = _is_circular_vertex(geom, m.vertexIndex())
+            if m.layer():
+                metadata = self.cached_vertex_metadata(m.layer(), m.featureId())
+                is_circular_vertex = metadata.curve[m.vertexIndex()] == 1
 
             self.vertex_band.setIcon(QgsRubberBand.ICON_FULL_BOX if is_circular_vertex else QgsRubberBand.ICON_CIRCLE)
             # if we are at an endpoint, let's show also the endpoint indicator
@@ -522,13 +706,15 @@ class NodeTool(QgsMapToolAdvancedDigitizing):
         if m.type() == QgsPointLocator.Edge:
             map_point = self.toMapCoordinates(e.pos())
             edge_center, is_near_center = self._match_edge_center_test(m, map_point)
-            self.edge_center_marker.setCenter(edge_center)
+            self.edge_center_marker.setCenter(QgsPoint(*edge_center))
             self.edge_center_marker.setColor(Qt.red if is_near_center else Qt.gray)
             self.edge_center_marker.setVisible(True)
             self.edge_center_marker.update()
 
             p0, p1 = m.edgePoints()
-            self.edge_band.setToGeometry(QgsGeometry.fromPolyline([p0, p1]), None)
+            self.edge_band.reset(QGis.Line)
+            self.edge_band.addPoint(p0, False)
+            self.edge_band.addPoint(p1)
             self.edge_band.setVisible(not is_near_center)
         else:
             self.edge_center_marker.setVisible(False)
@@ -538,24 +724,54 @@ class NodeTool(QgsMapToolAdvancedDigitizing):
         if m.isValid() and m.layer():
             if self.feature_band_source == (m.layer(), m.featureId()):
                 return  # skip regeneration of rubber band if not needed
-            geom = self.cached_geometry(m.layer(), m.featureId())
-            if QgsWKBTypes.isCurvedType(geom.geometry().wkbType()):
-                geom = QgsGeometry(geom.geometry().segmentize())
-            self.feature_band.setToGeometry(geom, m.layer())
-            self.feature_band.setVisible(True)
-            self.feature_band_source = (m.layer(), m.featureId())
+            self.show_feature_band(m.layer(), m.featureId())
         else:
             self.feature_band.setVisible(False)
             self.feature_band_source = None
 
+    def show_feature_band(self, layer, fid):
+        """ Highlight the feature - its geometry is simplified and clipped for the current extent """
+        with self.latency.stage("highlight"):
+            geom = self.cached_geometry(layer, fid)
+            geom = self.highlight_cache.geometry(layer, fid, geom, self.canvas().mapSettings())
+            self.feature_band.setToGeometry(geom, layer)
+        self.feature_band.setVisible(True)
+        self.feature_band_source = (layer, fid)
+
+    def on_extents_changed(self):
+        # the highlighted feature is clipped to the visible extent - it needs to be regenerated now,
+        # the band would show the outline for the old extent until the mouse moves otherwise
+        if self.feature_band_source is None:
+            return
+        layer, fid = self.feature_band_source
+        self.feature_band_source = None
+        self.feature_band.setVisible(False)
+        # (only if still cached - a deleted feature is dropped from the cache)
+        if layer.isEditable() and self.cache.contains(layer, fid):
+            self.show_feature_band(layer, fid)
+
+    @timed("key")
     def keyPressEvent(self, e):
 
-        if not self.dragging and len(self.selected_nodes) == 0:
+        if e.key() == Qt.Key_Escape and self.node_selection is not None:
+            self.cancel_node_selection()
+            return
+
+        if e.key() == Qt.Key_Escape and self.selection_polygon is not None:
+            self.stop_selection_polygon()
+            return
+
+        if not self.dragging and len(self.selected_nodes) == 0 and self.node_selection is None:
             return
 
         if e.key() == Qt.Key_Delete:
             e.ignore()  # Override default shortcut management
-            self.delete_vertex()
+            if self.node_selection is not None:
+                # delete the whole selection, not just what has been found so far (Esc cancels it)
+                self.delete_after_selection = True
+                return
+            with self.request_stats.interaction(DELETE):
+                self.delete_vertex()
         elif e.key() == Qt.Key_Escape:
             if self.dragging:
                 self.stop_dragging()
@@ -566,35 +782,37 @@ class NodeTool(QgsMapToolAdvancedDigitizing):
 
     # ------------
 
+    @timed("fetch_geometry")
     def cached_geometry(self, layer, fid):
-        if layer not in self.cache:
-            self.cache[layer] = {}
-            layer.geometryChanged.connect(self.on_cached_geometry_changed)
-            layer.featureDeleted.connect(self.on_cached_geometry_deleted)
-
-        if fid not in self.cache[layer]:
-            f = layer.getFeatures(QgsFeatureRequest(fid)).next()
-            self.cache[layer][fid] = QgsGeometry(f.geometry())
-
-        return self.cache[layer][fid]
+        return self.cache.geometry(layer, fid)
 
     def cached_geometry_for_vertex(self, vertex):
         return self.cached_geometry(vertex.layer, vertex.fid)
 
-    def on_cached_geometry_changed(self, fid, geom):
-        """ update geometry of our feature """
-        layer = self.sender()
-        assert layer in self.cache
-        if fid in self.cache[layer]:
-            self.cache[layer][fid] = QgsGeometry(geom)
+    def cached_vertex_offsets(self, layer, fid):
+        return self.cache.vertex_offsets(layer, fid)
+
+    def cached_vertex_metadata(self, layer, fid):
+        return self.cache.vertex_metadata(layer, fid)
+
+    def cached_vertex_coordinates(self, layer, fid):
+        return self.cache.vertex_coordinates(layer, fid)
 
-    def on_cached_geometry_deleted(self, fid):
-        layer = self.sender()
-        assert layer in self.cache
-        if fid in self.cache[layer]:
-            del self.cache[layer][fid]
+    def prefetch_vertices(self, vertices):
+        """ Fetch geometries of all features referenced by the list of Vertex instances
+        (or matches) with one request per layer """
+        fids_per_layer = {}   # { layer : set of fids }
+        for v in vertices:
+            if isinstance(v, QgsPointLocator.Match):
+                layer, fid = v.layer(), v.featureId()
+            else:
+                layer, fid = v.layer, v.fid
+            fids_per_layer.setdefault(layer, set()).add(fid)
+        for layer, fids in fids_per_layer.iteritems():
+            self.cache.prefetch(layer, fids)
 
 
+    @timed("drag_start")
     def start_dragging(self, e):
 
         map_point = self.toMapCoordinates(e.pos())
@@ -602,7 +820,7 @@ class NodeTool(QgsMapToolAdvancedDigitizing):
             self.start_dragging_add_vertex_at_endpoint(map_point)
             return
 
-        m = self.snap_to_editable_layer(e)
+        m = self.snap_from_hover(e)
         if not m.isValid():
             print "wrong snap!"
             return
@@ -632,16 +850,17 @@ class NodeTool(QgsMapToolAdvancedDigitizing):
         # start dragging of snapped point of current layer
         self.dragging = Vertex(m.layer(), m.featureId(), m.vertexIndex())
         self.dragging_topo = []
+        moving = self.drag_preview.add_moving_point(m.point())
 
         v0idx, v1idx = geom.adjacentVertices(m.vertexIndex())
         if v0idx != -1:
             layer_point0 = geom.vertexAt(v0idx)
-            map_point0 = self.toMapCoordinates(m.layer(), layer_point0)
-            self.add_drag_band(map_point0, m.point())
+            map_point0 = self.transforms.to_map_point(m.layer(), layer_point0)
+            self.drag_preview.add_anchor(map_point0, moving)
         if v1idx != -1:
             layer_point1 = geom.vertexAt(v1idx)
-            map_point1 = self.toMapCoordinates(m.layer(), layer_point1)
-            self.add_drag_band(map_point1, m.point())
+            map_point1 = self.transforms.to_map_point(m.layer(), layer_point1)
+            self.drag_preview.add_anchor(map_point1, moving)
 
         if v0idx == -1 and v1idx == -1:
             # this is a standalone point - we need to use a marker for it
@@ -655,59 +874,41 @@ class NodeTool(QgsMapToolAdvancedDigitizing):
             return  # we are done now
 
         # support for topo editing - find extra features
+        # (vertices at exactly the same location in any editable layer)
+        layer_point = vertex_at_vertex_index(geom, m.vertexIndex(), self.cached_vertex_offsets(m.layer(), m.featureId()))
+        # only features around the vertex get indexed (the area may be reused by next drags)
+        tol = QgsTolerance.vertexSearchRadius(self.canvas().mapSettings())
+        map_rect = QgsRectangle(m.point().x() - tol, m.point().y() - tol, m.point().x() + tol, m.point().y() + tol)
         for layer in self.canvas().layers():
             if not isinstance(layer, QgsVectorLayer) or not layer.isEditable():
                 continue
 
-            for other_m in self.layer_vertices_snapped_to_point(layer, map_point):
-                if other_m == m: continue
-
-                other_g = self.cached_geometry(other_m.layer(), other_m.featureId())
-
-                # start dragging of snapped point of current layer
-                self.dragging_topo.append( Vertex(other_m.layer(), other_m.featureId(), other_m.vertexIndex()) )
-
-                v0idx, v1idx = other_g.adjacentVertices(other_m.vertexIndex())
-                if v0idx != -1:
-                    other_point0 = other_g.vertexAt(v0idx)
-                    other_map_point0 = self.toMapCoordinates(other_m.layer(), other_point0)
-                    self.add_drag_band(other_map_point0, other_m.point())
-                if v1idx != -1:
-                    other_point1 = other_g.vertexAt(v1idx)
-                    other_map_point1 = self.toMapCoordinates(other_m.layer(), other_point1)
-                    self.add_drag_band(other_map_point1, other_m.point())
-
-    def layer_vertices_snapped_to_point(self, layer, map_point):
-        """ Get list of matches of all vertices of a layer exactly snapped to a map point """
-
-        class MyFilter(QgsPointLocator.MatchFilter):
-            """ a filter just to gather all matches at the same place """
-            def __init__(self, nodetool):
-                QgsPointLocator.MatchFilter.__init__(self)
-                self.matches = []
-                self.nodetool = nodetool
-            def acceptMatch(self, match):
-                if match.distance() > 0:
-                    return False
-                self.matches.append(match)
-
-                # there may be multiple points at the same location, but we get only one
-                # result... the locator API needs a new method verticesInRect()
-                match_geom = self.nodetool.cached_geometry(match.layer(), match.featureId())
-                vid = QgsVertexId()
-                pt = QgsPointV2()
-                while match_geom.geometry().nextVertex(vid, pt):
-                    vindex = match_geom.vertexNrFromVertexId(vid)
-                    if pt.x() == match.point().x() and pt.y() == match.point().y() and vindex != match.vertexIndex():
-                        extra_match = QgsPointLocator.Match(match.type(), match.layer(), match.featureId(),
-                                                            0, match.point(), vindex)
-                        self.matches.append(extra_match)
-                return True
-
-        myfilter = MyFilter(self)
-        loc = self.canvas().snappingUtils().locatorForLayer(layer)
-        loc.nearestVertex(map_point, 0, myfilter)
-        return myfilter.matches
+            if layer.crs() == m.layer().crs():
+                point = layer_point
+            else:
+                point = self.transforms.to_layer_point(layer, m.point())
+
+            layer_rect = self.transforms.to_layer_rect(layer, map_rect)
+            for other_layer, other_fid, other_vertex_id in self.topology.vertices_at(layer, point.x(), point.y(), layer_rect):
+                if other_layer == m.layer() and other_fid == m.featureId() and other_vertex_id == m.vertexIndex():
+                    continue
+                self.dragging_topo.append( Vertex(other_layer, other_fid, other_vertex_id) )
+
+        # normally nothing to fetch - the topology index has passed the geometries to the cache
+        self.prefetch_vertices(self.dragging_topo)
+
+        for topo in self.dragging_topo:
+            other_g = self.cached_geometry_for_vertex(topo)
+
+            v0idx, v1idx = other_g.adjacentVertices(topo.vertex_id)
+            if v0idx != -1:
+                other_point0 = other_g.vertexAt(v0idx)
+                other_map_point0 = self.transforms.to_map_point(topo.layer, other_point0)
+                self.drag_preview.add_anchor(other_map_point0, moving)
+            if v1idx != -1:
+                other_point1 = other_g.vertexAt(v1idx)
+                other_map_point1 = self.transforms.to_map_point(topo.layer, other_point1)
+                self.drag_preview.add_anchor(other_map_point1, moving)
 
     def start_dragging_add_vertex(self, m):
 
@@ -725,13 +926,14 @@ class NodeTool(QgsMapToolAdvancedDigitizing):
         v0 = geom.vertexAt(m.vertexIndex())
         v1 = geom.vertexAt(m.vertexIndex()+1)
 
-        map_v0 = self.toMapCoordinates(m.layer(), v0)
-        map_v1 = self.toMapCoordinates(m.layer(), v1)
+        map_v0 = self.transforms.to_map_point(m.layer(), v0)
+        map_v1 = self.transforms.to_map_point(m.layer(), v1)
 
+        moving = self.drag_preview.add_moving_point(m.point())
         if v0.x() != 0 or v0.y() != 0:
-            self.add_drag_band(map_v0, m.point())
+            self.drag_preview.add_anchor(map_v0, moving)
         if v1.x() != 0 or v1.y() != 0:
-            self.add_drag_band(map_v1, m.point())
+            self.drag_preview.add_anchor(map_v1, moving)
 
         self.override_cad_points = [m.point(), m.point()]
 
@@ -747,13 +949,15 @@ class NodeTool(QgsMapToolAdvancedDigitizing):
 
         geom = self.cached_geometry(self.mouse_at_endpoint.layer, self.mouse_at_endpoint.fid)
         v0 = geom.vertexAt(self.mouse_at_endpoint.vertex_id)
-        map_v0 = self.toMapCoordinates(self.mouse_at_endpoint.layer, v0)
+        map_v0 = self.transforms.to_map_point(self.mouse_at_endpoint.layer, v0)
 
-        self.add_drag_band(map_v0, map_point)
+        moving = self.drag_preview.add_moving_point(map_point)
+        self.drag_preview.add_anchor(map_v0, moving)
 
         # setup CAD dock previous points to endpoint and the previous point
-        pt0 = vertex_at_vertex_index(geom, adjacent_vertex_index_to_endpoint(geom, self.mouse_at_endpoint.vertex_id))
-        pt1 = vertex_at_vertex_index(geom, self.mouse_at_endpoint.vertex_id)
+        offsets = self.cached_vertex_offsets(self.mouse_at_endpoint.layer, self.mouse_at_endpoint.fid)
+        pt0 = vertex_at_vertex_index(geom, adjacent_vertex_index_to_endpoint(geom, self.mouse_at_endpoint.vertex_id, offsets), offsets)
+        pt1 = vertex_at_vertex_index(geom, self.mouse_at_endpoint.vertex_id, offsets)
         self.override_cad_points = [pt0, pt1]
 
     def start_dragging_edge(self, m, map_point):
@@ -766,32 +970,66 @@ class NodeTool(QgsMapToolAdvancedDigitizing):
         self.dragging_edge = Edge(m.layer(), m.featureId(), m.vertexIndex(), map_point)
         self.dragging_topo = []
 
-        edge_p0, edge_p1 = m.edgePoints()
-        geom = self.cached_geometry(m.layer(), m.featureId())
-
-        bands_to_p0, bands_to_p1 = [], []
-
-        # add drag bands
-        self.add_drag_band(edge_p0, edge_p1)
-        v0idx, _ = geom.adjacentVertices(m.vertexIndex())
-        _, v1idx = geom.adjacentVertices(m.vertexIndex()+1)
-        if v0idx != -1:
-            layer_point0 = geom.vertexAt(v0idx)
-            map_point0 = self.toMapCoordinates(m.layer(), layer_point0)
-            self.add_drag_band(map_point0, edge_p0)
-            bands_to_p0.append(self.drag_bands[-1])
-        if v1idx != -1:
-            layer_point1 = geom.vertexAt(v1idx)
-            map_point1 = self.toMapCoordinates(m.layer(), layer_point1)
-            self.add_drag_band(map_point1, edge_p1)
-            bands_to_p1.append(self.drag_bands[-1])
-
-        self.dragging_edge_bands = (self.drag_bands[0], bands_to_p0, bands_to_p1)
+        # if the edge is selected, all selected edges are moved together
+        if self.is_selected_edge(m):
+            edge_vertices = self.selected_nodes
+        else:
+            edge_vertices = [Vertex(m.layer(), m.featureId(), m.vertexIndex()),
+                             Vertex(m.layer(), m.featureId(), m.vertexIndex()+1)]
+        self.prefetch_vertices(edge_vertices)
+
+        vertex_ids_grouped = {}   # { (layer, fid) : set of vertex ids }
+        for v in edge_vertices:
+            vertex_ids_grouped.setdefault((v.layer, v.fid), set()).add(v.vertex_id)
+
+        # capture map coordinates of moved vertices and of their fixed neighbors just once,
+        # mouse moves then only offset the moving points of the drag preview
+        added_segments = set()  # to avoid drawing twice segments around start/end of closed rings
+        for (layer, fid), vertex_ids in vertex_ids_grouped.iteritems():
+            metadata = self.cached_vertex_metadata(layer, fid)
+            vertex_ids = set(vertex_id for vertex_id in vertex_ids if 0 <= vertex_id < len(metadata.prev))
+            # only vertices that are endpoints of some selected edge are moved
+            moving_ids = sorted(vertex_id for vertex_id in vertex_ids
+                                if metadata.prev[vertex_id] in vertex_ids or metadata.next[vertex_id] in vertex_ids)
+            neighbor_ids = [metadata.prev[vertex_id] for vertex_id in moving_ids] + \
+                           [metadata.next[vertex_id] for vertex_id in moving_ids]
+            neighbor_ids = [vertex_id for vertex_id in neighbor_ids if vertex_id != -1]
+
+            xs, ys = self.cached_vertex_coordinates(layer, fid)
+            coord_ids = moving_ids + neighbor_ids
+            map_xs, map_ys = self.transforms.to_map_arrays(layer, *take_coordinates(xs, ys, coord_ids))
+            map_coords = dict((vertex_id, (map_xs[i], map_ys[i])) for i, vertex_id in enumerate(coord_ids))
+
+            moving_index = {}   # { vertex id : index of moving point in drag preview }
+            for vertex_id in moving_ids:
+                x, y = map_coords[vertex_id]
+                moving_index[vertex_id] = self.drag_preview.add_moving_point(QgsPoint(x, y))
+                self.dragging_edge.vertices.append(Vertex(layer, fid, vertex_id))
+                self.dragging_edge.map_xs.append(x)
+                self.dragging_edge.map_ys.append(y)
+
+            for vertex_id in moving_ids:
+                for other_id in (metadata.prev[vertex_id], metadata.next[vertex_id]):
+                    if other_id == -1:
+                        continue
+                    segment_key = (layer, fid, frozenset((map_coords[vertex_id], map_coords[other_id])))
+                    if segment_key in added_segments:
+                        continue
+                    added_segments.add(segment_key)
+                    if other_id in moving_index:
+                        self.drag_preview.add_moving_segment(moving_index[vertex_id], moving_index[other_id])
+                    else:
+                        self.drag_preview.add_anchor(QgsPoint(*map_coords[other_id]), moving_index[vertex_id])
 
         self.override_cad_points = [m.point(), m.point()]
 
         # TODO: add topo points
 
+    def is_selected_edge(self, m):
+        """ Whether both endpoints of the matched edge are among the selected nodes """
+        return (m.layer(), m.featureId(), m.vertexIndex()) in self.selected_node_keys and \
+               (m.layer(), m.featureId(), m.vertexIndex()+1) in self.selected_node_keys
+
 
     def stop_dragging(self):
 
@@ -807,68 +1045,90 @@ class NodeTool(QgsMapToolAdvancedDigitizing):
 
         self.dragging = False
         self.dragging_edge = None
-        self.dragging_edge_bands = None
-        self.clear_drag_bands()
+        self.clear_drag_preview()
 
     def match_to_layer_point(self, dest_layer, map_point, match):
 
         layer_point = None
         # try to use point coordinates in the original CRS if it is the same
         if match and match.hasVertex() and match.layer() and match.layer().crs() == dest_layer.crs():
-            try:
-                f = match.layer().getFeatures(QgsFeatureRequest(match.featureId())).next()
-                layer_point = f.geometry().vertexAt(match.vertexIndex())
-            except StopIteration:
-                pass
+            map_settings = self.canvas().mapSettings()
+            reprojected = map_settings.hasCrsTransformEnabled() and dest_layer.crs() != map_settings.destinationCrs()
+            if reprojected or self.cache.contains(match.layer(), match.featureId()):
+                xs, ys = self.cached_vertex_coordinates(match.layer(), match.featureId())
+                if match.vertexIndex() < len(xs):
+                    layer_point = QgsPoint(xs[match.vertexIndex()], ys[match.vertexIndex()])
+            else:
+                layer_point = match.point()   # map point is exact - no need to fetch the feature
 
         # fall back to reprojection of the map point to layer point if they are not the same CRS
         if layer_point is None:
-            layer_point = self.toLayerCoordinates(dest_layer, map_point)
+            layer_point = self.transforms.to_layer_point(dest_layer, map_point)
         return layer_point
 
+    @timed("drop")
     def move_edge(self, map_point):
         """ Finish moving of an edge """
 
-        drag_layer = self.dragging_edge.layer
-        drag_fid = self.dragging_edge.fid
-        drag_vertex_0 = self.dragging_edge.edge_vertex_0
-        drag_start_point = self.dragging_edge.start_map_point
+        dragging_edge = self.dragging_edge
+        drag_start_point = dragging_edge.start_map_point
 
         self.stop_dragging()
 
         diff_x, diff_y = map_point.x() - drag_start_point.x(), map_point.y() - drag_start_point.y()
 
-        geom = QgsGeometry(self.cached_geometry(drag_layer, drag_fid))
-
         # TODO: move topo points
 
-        drag_layer.beginEditCommand(self.tr("Moved edge"))
+        applier = EditApplier(self.cache)
 
-        # move first endpoint
-        orig_map_point_0 = self.toMapCoordinates(drag_layer, geom.vertexAt(drag_vertex_0))
-        new_map_point_0 = QgsPoint(orig_map_point_0.x() + diff_x, orig_map_point_0.y() + diff_y)
-        self.dragging = Vertex(drag_layer, drag_fid, drag_vertex_0)
-        self.move_vertex(new_map_point_0, None)
+        # move all vertices of the dragged edge(s) by the same offset
+        for i, vertex in enumerate(dragging_edge.vertices):
+            new_map_point = QgsPoint(dragging_edge.map_xs[i] + diff_x, dragging_edge.map_ys[i] + diff_y)
+            self.plan_vertex_move(applier, vertex, [], new_map_point, None)
 
-        # move second endpoint
-        orig_map_point_1 = self.toMapCoordinates(drag_layer, geom.vertexAt(drag_vertex_0+1))
-        new_map_point_1 = QgsPoint(orig_map_point_1.x() + diff_x, orig_map_point_1.y() + diff_y)
-        self.dragging = Vertex(drag_layer, drag_fid, drag_vertex_0+1)
-        self.move_vertex(new_map_point_1, None)
-
-        drag_layer.endEditCommand()
+        self.apply_edits(applier, self.tr("Moved edge"))
 
+    @timed("drop")
     def move_vertex(self, map_point, map_point_match):
 
         # deactivate advanced digitizing
         self.setMode(self.CaptureNone)
 
-        drag_layer = self.dragging.layer
-        drag_fid = self.dragging.fid
-        drag_vertex_id = self.dragging.vertex_id
-        geom = QgsGeometry(self.cached_geometry_for_vertex(self.dragging))
+        dragging = self.dragging
         self.stop_dragging()
 
+        applier = EditApplier(self.cache)
+        if not self.plan_vertex_move(applier, dragging, self.dragging_topo, map_point, map_point_match):
+            return
+
+        self.apply_edits(applier, self.tr("Moved vertex"))
+
+    def move_vertices_to(self, layer, fid, moves):
+        """ Move vertices of a feature to given coordinates (in layer CRS) as one edit.
+        Argument moves is a list of tuples (vertex index, x, y) """
+        applier = EditApplier(self.cache)
+        for vertex_id, x, y in moves:
+            if not applier.move_vertex(layer, fid, vertex_id, x, y):
+                print "move vertex failed!", layer.name(), fid, vertex_id
+        self.apply_edits(applier, self.tr("Edited vertex coordinates"))
+
+    def apply_edits(self, applier, text):
+        """ Apply edits planned in the EditApplier and keep durations of their phases """
+        applier.apply(text)
+        self.hover_snap = None   # the hovered geometry may have changed
+        self.last_edit_timings = applier.timings
+        if self.latency.enabled:
+            for phase, duration in applier.timings.iteritems():
+                self.latency.record("edit_" + phase, duration)
+
+    def plan_vertex_move(self, applier, vertex, topo_vertices, map_point, map_point_match):
+        """ Add to the edit applier move (or addition) of a vertex to the given map point,
+        together with topologically connected vertices. Returns False on failure """
+
+        drag_layer = vertex.layer
+        drag_fid = vertex.fid
+        drag_vertex_id = vertex.vertex_id
+
         adding_vertex = False
         adding_at_endpoint = False
         if isinstance(drag_vertex_id, tuple):
@@ -879,53 +1139,34 @@ class NodeTool(QgsMapToolAdvancedDigitizing):
 
         # add/move vertex
         if adding_vertex:
-            # ordinary geom.insertVertex does not support appending so we use geometry V2
-            drag_part, drag_ring, drag_vertex = vertex_index_to_tuple(geom, drag_vertex_id)
+            # ordinary geom.insertVertex does not support appending so the applier uses geometry V2
+            offsets = applier.vertex_offsets(drag_layer, drag_fid)
+            drag_part, drag_ring, drag_vertex = offsets.to_tuple(drag_vertex_id)
             if adding_at_endpoint and drag_vertex != 0:  # appending?
                 drag_vertex += 1
-            vid = QgsVertexId(drag_part, drag_ring, drag_vertex, QgsVertexId.SegmentVertex)
-            geom_tmp = geom.geometry().clone()
-            if not geom_tmp.insertVertex(vid, QgsPointV2(layer_point)):
+            if not applier.insert_vertex(drag_layer, drag_fid, drag_part, drag_ring, drag_vertex, layer_point.x(), layer_point.y()):
                 print "append vertex failed!"
-                return
-            geom.setGeometry(geom_tmp)
+                return False
         else:
-            if not geom.moveVertex(layer_point.x(), layer_point.y(), drag_vertex_id):
+            if not applier.move_vertex(drag_layer, drag_fid, drag_vertex_id, layer_point.x(), layer_point.y()):
                 print "move vertex failed!"
-                return
-
-        edits = { drag_layer: { drag_fid: geom } }  # dict { layer : { fid : geom } }
+                return False
 
         # add moved vertices from other layers
-        for topo in self.dragging_topo:
-            if topo.layer not in edits:
-                edits[topo.layer] = {}
-            if topo.fid in edits[topo.layer]:
-                topo_geom = QgsGeometry(edits[topo.layer][topo.fid])
-            else:
-                topo_geom = QgsGeometry(self.cached_geometry_for_vertex(topo))
-
+        for topo in topo_vertices:
             if topo.layer.crs() == drag_layer.crs():
                 point = layer_point
             else:
-                point = self.toLayerCoordinates(topo.layer, map_point)
+                point = self.transforms.to_layer_point(topo.layer, map_point)
 
-            if not topo_geom.moveVertex(point.x(), point.y(), topo.vertex_id):
+            if not applier.move_vertex(topo.layer, topo.fid, topo.vertex_id, point.x(), point.y()):
                 print "[topo] move vertex failed!"
-                continue
-            edits[topo.layer][topo.fid] = topo_geom
 
         # TODO: add topological points: when moving vertex - if snapped to something
 
-        # do the changes to layers
-        for layer, features_dict in edits.iteritems():
-            layer.beginEditCommand( self.tr( "Moved vertex" ) )
-            for fid, geometry in features_dict.iteritems():
-                layer.changeGeometry(fid, geometry)
-            layer.endEditCommand()
-            layer.triggerRepaint()
-
+        return True
 
+    @timed("delete")
     def delete_vertex(self):
 
         if len(self.selected_nodes) != 0:
@@ -940,6 +1181,8 @@ class NodeTool(QgsMapToolAdvancedDigitizing):
 
         self.set_highlighted_nodes([])   # reset selection
 
+        self.prefetch_vertices(to_delete)
+
         # switch from a plain list to dictionary { layer: { fid: [vertexNr1, vertexNr2, ...] } }
         to_delete_grouped = {}
         for vertex in to_delete:
@@ -950,25 +1193,15 @@ class NodeTool(QgsMapToolAdvancedDigitizing):
             to_delete_grouped[vertex.layer][vertex.fid].append(vertex.vertex_id)
 
         # main for cycle to delete all selected vertices
+        applier = EditApplier(self.cache)
         for layer, features_dict in to_delete_grouped.iteritems():
-
-            layer.beginEditCommand( self.tr( "Deleted vertex" ) )
-            success = True
-
             for fid, vertex_ids in features_dict.iteritems():
-                res = QgsVectorLayer.Success
-                for vertex_id in sorted(vertex_ids, reverse=True):
-                    if res != QgsVectorLayer.EmptyGeometry:
-                        res = layer.deleteVertexV2(fid, vertex_id)
-                    if res != QgsVectorLayer.EmptyGeometry and res != QgsVectorLayer.Success:
-                        print "failed to delete vertex!", layer.name(), fid, vertex_id, vertex_ids
-                        success = False
-
-            if success:
-                layer.endEditCommand()
-                layer.triggerRepaint()
-            else:
-                layer.destroyEditCommand()
+                # remove all vertices of the feature at once and change its geometry just once
+                if not applier.delete_vertices(layer, fid, vertex_ids):
+                    print "failed to delete vertex!", layer.name(), fid, vertex_ids
+                    applier.discard_layer(layer)   # the layer is left untouched
+                    break
+        self.apply_edits(applier, self.tr("Deleted vertex"))
 
         # pre-select next node for deletion if we are deleting just one node
         if len(to_delete) == 1:
@@ -984,21 +1217,31 @@ class NodeTool(QgsMapToolAdvancedDigitizing):
 
 
 
+    @timed("selection_markers")
     def set_highlighted_nodes(self, list_nodes):
-        for marker in self.selected_nodes_markers:
-            self.canvas().scene().removeItem(marker)
-        self.selected_nodes_markers = []
+        self.prefetch_vertices(list_nodes)
 
+        # group vertex indices by feature so their coordinates are taken from cached arrays at once
+        vertex_ids_grouped = {}   # { (layer, fid) : [vertexNr1, vertexNr2, ...] }
         for node in list_nodes:
-            geom = self.cached_geometry_for_vertex(node)
-            marker = QgsVertexMarker(self.canvas())
-            marker.setIconType(QgsVertexMarker.ICON_CIRCLE)
-            #marker.setIconSize(5)
-            #marker.setPenWidth(2)
-            marker.setColor(Qt.blue)
-            marker.setCenter(geom.vertexAt(node.vertex_id))
-            self.selected_nodes_markers.append(marker)
+            vertex_ids_grouped.setdefault((node.layer, node.fid), []).append(node.vertex_id)
+
+        self.selected_nodes_item.clear()
+        for (layer, fid), vertex_ids in vertex_ids_grouped.iteritems():
+            xs, ys = self.cached_vertex_coordinates(layer, fid)
+            vertex_ids = [vertex_id for vertex_id in vertex_ids if 0 <= vertex_id < len(xs)]
+            xs, ys = take_coordinates(xs, ys, vertex_ids)
+            self.selected_nodes_item.add_points(*self.transforms.to_map_arrays(layer, xs, ys))
         self.selected_nodes = list_nodes
+        self.selected_node_keys = set((node.layer, node.fid, node.vertex_id) for node in list_nodes)
+        self.highlighted_nodes_changed.emit()
+
+    def add_highlighted_nodes(self, layer, fid, vertex_ids, xs, ys):
+        """ Add nodes of a feature to the selection - with their coordinates (in layer CRS) already known """
+        self.selected_nodes_item.add_points(*self.transforms.to_map_arrays(layer, xs, ys))
+        self.selected_nodes.extend(Vertex(layer, fid, vertex_id) for vertex_id in vertex_ids)
+        self.selected_node_keys.update((layer, fid, vertex_id) for vertex_id in vertex_ids)
+        self.highlighted_nodes_changed.emit()
 
     def highlight_adjacent_vertex(self, offset):
         """Allow moving back and forth selected vertex within a feature"""
@@ -1036,24 +1279,97 @@ class NodeTool(QgsMapToolAdvancedDigitizing):
         self.selection_rect_item = None
         self.selection_rect = None
 
+    def start_selection_polygon(self, map_point, lasso):
+        """ Start drawing of a lasso (points added on mouse moves) or a polygon (points added on clicks) """
+        self.selection_polygon = [map_point]
+        self.selection_polygon_lasso = lasso
+        color = QColor(Qt.blue)
+        color.setAlpha(63)
+        self.selection_polygon_band = QgsRubberBand(self.canvas(), QGis.Polygon)
+        self.selection_polygon_band.setColor(color)
+        self.selection_polygon_band.addPoint(map_point)
+        if not lasso:
+            self.selection_polygon_band.addPoint(map_point)   # the last point follows the mouse
+
+    def add_selection_polygon_point(self, map_point):
+        self.selection_polygon.append(map_point)
+        if not self.selection_polygon_lasso:
+            self.selection_polygon_band.movePoint(map_point)
+        self.selection_polygon_band.addPoint(map_point)
+
+    def update_selection_polygon(self, map_point):
+        if not self.selection_polygon_lasso:
+            self.selection_polygon_band.movePoint(map_point)
+            return
+        # do not add lasso points closer than a few pixels
+        last_point = self.selection_polygon[-1]
+        tol = 3 * self.canvas().mapUnitsPerPixel()
+        if abs(map_point.x() - last_point.x()) >= tol or abs(map_point.y() - last_point.y()) >= tol:
+            self.add_selection_polygon_point(map_point)
+
+    def finish_selection_polygon(self):
+        map_points = self.selection_polygon
+        self.stop_selection_polygon()
+        if len(map_points) >= 3:
+            with self.request_stats.interaction(POLYGON_SELECT):
+                self.select_nodes_in_polygon(map_points)
+
+    def stop_selection_polygon(self):
+        self.canvas().scene().removeItem(self.selection_polygon_band)
+        self.selection_polygon_band = None
+        self.selection_polygon = None
+
+    @timed("polygon_select")
+    def select_nodes_in_polygon(self, map_points):
+        """ Select nodes of editable layers within polygon given by a list of QgsPoint in map coordinates """
+        map_xs = array('d', (pt.x() for pt in map_points))
+        map_ys = array('d', (pt.y() for pt in map_points))
+
+        self.set_highlighted_nodes([])
+
+        for layer in self.canvas().layers():
+            if not isinstance(layer, QgsVectorLayer) or not layer.isEditable():
+                continue
+            poly_xs, poly_ys = self.transforms.to_layer_arrays(layer, map_xs, map_ys)
+            layer_rect = QgsRectangle(min(poly_xs), min(poly_ys), max(poly_xs), max(poly_ys))
+
+            # vertices of all candidate features are tested at once
+            fids, coordinates, starts = [], [], [0]
+            request = QgsFeatureRequest(layer_rect).setSubsetOfAttributes([])
+            for f in self.request_stats.get_features(layer, request):
+                xs, ys = vertex_coordinates(f.geometry())
+                fids.append(f.id())
+                coordinates.append((xs, ys))
+                starts.append(starts[-1] + len(xs))
+            all_xs, all_ys = concatenate_coordinates(coordinates)
+
+            feature_index = 0
+            vertex_ids = []
+            for i in vertex_indices_in_polygon(all_xs, all_ys, poly_xs, poly_ys):   # sorted indices
+                if i >= starts[feature_index+1]:
+                    self._add_polygon_selection(layer, fids, coordinates, feature_index, vertex_ids)
+                    feature_index = bisect_right(starts, i) - 1
+                    vertex_ids = []
+                vertex_ids.append(i - starts[feature_index])
+            self._add_polygon_selection(layer, fids, coordinates, feature_index, vertex_ids)
+
+    def _add_polygon_selection(self, layer, fids, coordinates, feature_index, vertex_ids):
+        if len(vertex_ids) != 0:
+            xs, ys = coordinates[feature_index]
+            self.add_highlighted_nodes(layer, fids[feature_index], vertex_ids, *take_coordinates(xs, ys, vertex_ids))
+
 
     def _match_edge_center_test(self, m, map_point):
         """ Using a given edge match and original map point, find out
-         center of the edge and whether we are close enough to the center """
+         center of the edge (tuple x, y) and whether we are close enough to the center """
         p0, p1 = m.edgePoints()
 
-        visible_extent = self.canvas().mapSettings().visibleExtent()
-        if not visible_extent.contains(p0) or not visible_extent.contains(p1):
-            # clip line segment to the extent so the mid-point marker is always visible
-            extent_geom = QgsGeometry.fromRect(visible_extent)
-            line_geom = QgsGeometry.fromPolyline([p0, p1])
-            line_geom = extent_geom.intersection(line_geom)
-            p0, p1 = line_geom.asPolyline()
-
-        edge_center = QgsPoint((p0.x() + p1.x())/2, (p0.y() + p1.y())/2)
+        # clip line segment to the extent so the mid-point marker is always visible
+        extent = self.canvas().mapSettings().visibleExtent()
+        edge_center = visible_midpoint(p0.x(), p0.y(), p1.x(), p1.y(),
+                                       extent.xMinimum(), extent.yMinimum(), extent.xMaximum(), extent.yMaximum())
 
-        dist_from_edge_center = math.sqrt(map_point.sqrDist(edge_center))
         tol = QgsTolerance.vertexSearchRadius(self.canvas().mapSettings())
-        is_near_center = dist_from_edge_center < tol
+        is_near_center = sqr_dist(map_point.x(), map_point.y(), edge_center[0], edge_center[1]) < tol * tol
 
         return edge_center, is_near_center
@@ -0,0 +1,151 @@
+#-----------------------------------------------------------
+# Copyright (C) 2015 Martin Dobias
+#-----------------------------------------------------------
+# Licensed under the terms of GNU GPL 2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#---------------------------------------------------------------------
+
+from contextlib import contextmanager
+
+from qgis.core import *
+
+
+HOVER = "hover"
+DRAG_START = "drag_start"
+DROP = "drop"
+DELETE = "delete"
+RECT_SELECT = "rect_select"
+POLYGON_SELECT = "polygon_select"
+
+# requests of temporary point locators of layers without an index (sent by QGIS snapping utils
+# while the index is being built) - counted separately, outside of the interactions' budgets
+TEMP_LOCATOR = "temp_locator"
+
+# maximum number of feature requests to a single layer within one interaction.
+# Hover may need to fetch the newly highlighted feature, drag start may need to index
+# a layer for topological editing - everything else must be served from the cache.
+REQUEST_BUDGETS = {
+    HOVER: 1,
+    DRAG_START: 1,
+    DROP: 0,
+    DELETE: 1,
+    RECT_SELECT: 1,
+    POLYGON_SELECT: 1,
+}
+
+MAX_VIOLATIONS = 100   # how many of the last budget violations are kept
+
+
+class RequestStats(object):
+    """ Accounting of feature requests sent to layers by the node tool.
+    All requests should go through get_features() so they are counted per layer
+    and per type of interaction that is currently being handled. In strict mode
+    an interaction that exceeds its budget raises AssertionError (used by the benchmark
+    script with --check-budgets, which runs the tool's interactions on memory layers). """
+
+    def __init__(self, strict=False):
+        self.strict = strict
+        self.current = None       # name of the interaction being handled (or None)
+        self.current_counts = {}  # { layer id : number of requests } within the current interaction
+        self.counts = {}          # { interaction : { layer id : number of requests } } - totals
+        self.violations = []      # list of (interaction, layer id, number of requests) over budget - the last ones
+
+    @contextmanager
+    def interaction(self, name):
+        """ Context manager to mark that the requests within belong to the given interaction.
+        Nested interactions are counted as a part of the outer one. """
+        if self.current is not None:
+            yield
+            return
+
+        self.current = name
+        self.current_counts = {}
+        try:
+            yield
+        finally:
+            try:
+                self._check_budget()
+            finally:
+                self.current = None
+
+    def get_features(self, layer, request):
+        """ Return feature iterator for the request - and count the request """
+        self._count(layer)
+        return layer.getFeatures(request)
+
+    def feature_source(self, layer):
+        """ Return snapshot of layer's features that can be read in another thread - counted as a request """
+        self._count(layer)
+        return QgsVectorLayerFeatureSource(layer)
+
+    def count_temp_locator(self, layer):
+        """ Count a request of a temporary point locator that snapping utils create for the layer """
+        layer_counts = self.counts.setdefault(TEMP_LOCATOR, {})
+        layer_counts[layer.id()] = layer_counts.get(layer.id(), 0) + 1
+
+    def total(self, interaction=None):
+        """ Return total number of requests (for one interaction type or for all of them) """
+        if interaction is not None:
+            return sum(self.counts.get(interaction, {}).itervalues())
+        return sum(sum(layer_counts.itervalues()) for layer_counts in self.counts.itervalues())
+
+    def reset(self):
+        self.counts = {}
+        self.violations = []
+
+    def _count(self, layer):
+        interaction = self.current if self.current is not None else "other"
+        layer_counts = self.counts.setdefault(interaction, {})
+        layer_counts[layer.id()] = layer_counts.get(layer.id(), 0) + 1
+        self.current_counts[layer.id()] = self.current_counts.get(layer.id(), 0) + 1
+
+    def _check_budget(self):
+        budget = REQUEST_BUDGETS.get(self.current)
+        if budget is None:
+            return
+        for layer_id, count in self.current_counts.iteritems():
+            if count > budget:
+                self.violations.append((self.current, layer_id, count))
+                del self.violations[:-MAX_VIOLATIONS]
+                if self.strict:
+                    raise AssertionError("too many feature requests: %s %s %d" % (self.current, layer_id, count))
+                print "too many feature requests!", self.current, layer_id, count
+
+
+if True:  # testing
+    class _TestLayer(object):
+        def id(self):
+            return "test"
+        def getFeatures(self, request):
+            return iter([])
+
+    # bookkeeping only - the budgets of the tool's interactions are checked by
+    # benchmarks/benchmark_nodetool.py --check-budgets
+    stats = RequestStats(strict=True)
+    layer = _TestLayer()
+    with stats.interaction(RECT_SELECT):
+        stats.get_features(layer, None)
+        with stats.interaction(HOVER):
+            pass   # nested interaction is a part of the outer one
+    assert stats.violations == [] and stats.total(RECT_SELECT) == 1
+
+    exceeded = False
+    try:
+        with stats.interaction(RECT_SELECT):
+            stats.get_features(layer, None)
+            stats.get_features(layer, None)
+    except AssertionError:
+        exceeded = True
+    assert exceeded and stats.violations == [(RECT_SELECT, "test", 2)] and stats.current is None
+
+    for i in xrange(MAX_VIOLATIONS):
+        try:
+            with stats.interaction(DROP):
+                stats.get_features(layer, None)
+        except AssertionError:
+            pass
+    assert len(stats.violations) == MAX_VIOLATIONS and stats.violations[-1] == (DROP, "test", 1)
@@ -0,0 +1,153 @@
+#-----------------------------------------------------------
+# Copyright (C) 2015 Martin Dobias
+#-----------------------------------------------------------
+# Licensed under the terms of GNU GPL 2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#---------------------------------------------------------------------
+
+from PyQt4.QtCore import *
+
+from qgis.core import *
+
+from geomutils import vertex_coordinates
+
+
+MAX_RECTS = 64   # how many indexed areas of a layer are kept before starting over
+
+
+class NodeTopology(QObject):
+    """ Index of vertices of layers by their exact coordinates, so that vertices
+    shared by several features (or layers) can be found with a hash lookup.
+    Only areas around looked up locations are indexed (one rect request per new area),
+    whole layers are never loaded. Indexed features are kept up to date incrementally:
+    signals of the layers only mark features as dirty and all dirty features
+    of a layer are re-indexed with one request on the next lookup.
+    Fetched geometries are passed to the geometry cache, so the features do not need
+    to be fetched again (e.g. when the connected vertices start to be dragged).
+    Coordinates are in each layer's CRS. """
+
+    def __init__(self, cache, request_stats, parent=None):
+        QObject.__init__(self, parent)
+        self.cache = cache                   # GeometryCache that gets the fetched geometries
+        self.request_stats = request_stats   # RequestStats used to fetch features
+        self.nodes = {}      # { (x, y) : set of (layer, fid, vertex_index) }
+        self.features = {}   # { layer : { fid : list of (x, y) } } - to know what to remove on change
+        self.rects = {}      # { layer : list of QgsRectangle } - areas with all features indexed
+        self.dirty = {}      # { layer : set of fids } - features changed, added or deleted since indexed
+
+        QgsMapLayerRegistry.instance().layersWillBeRemoved.connect(self.on_layers_will_be_removed)
+
+    def vertices_at(self, layer, x, y, rect):
+        """ Return list of (layer, fid, vertex_index) tuples of vertices of the layer at exactly given location.
+        If the location has not been indexed yet, features within rect (around the location, in layer CRS)
+        get indexed first. At most one feature request is sent """
+        if layer not in self.features:
+            self._watch_layer(layer)
+        if not any(r.contains(QgsPoint(x, y)) for r in self.rects[layer]):
+            if layer in self.dirty or len(self.rects[layer]) >= MAX_RECTS:
+                # start over with just the new area - so there is no extra request to update the old ones
+                self._clear_layer(layer)
+            self.index_rect(layer, rect, x, y)
+        elif layer in self.dirty:
+            self._update_dirty(layer)
+        return [v for v in self.nodes.get((x, y), ()) if v[0] == layer]
+
+    def index_rect(self, layer, rect, x, y):
+        """ Add vertices of all features within the rect to the index. The rect gets extended to contain (x, y) """
+        rect = QgsRectangle(rect)
+        rect.combineExtentWith(x, y)
+        request = QgsFeatureRequest(rect).setSubsetOfAttributes([])
+        for f in self.request_stats.get_features(layer, request):
+            self._remove_feature(layer, f.id())   # may have been indexed within another area
+            self._add_feature(layer, f.id(), f.geometry())
+            self.cache.add(layer, f.id(), f.geometry())
+        self.rects[layer].append(rect)
+
+    def _watch_layer(self, layer):
+        self.features[layer] = {}
+        self.rects[layer] = []
+        layer.geometryChanged.connect(self.on_geometry_changed)
+        layer.featureAdded.connect(self.on_feature_added)
+        layer.featureDeleted.connect(self.on_feature_deleted)
+        layer.editingStopped.connect(self.on_editing_stopped)
+        layer.dataChanged.connect(self.on_data_changed)
+
+    def _clear_layer(self, layer):
+        """ Remove all vertices of the layer from the index - but keep watching it """
+        for fid in self.features[layer].keys():
+            self._remove_feature(layer, fid)
+        self.rects[layer] = []
+        self.dirty.pop(layer, None)
+
+    def drop_layer(self, layer):
+        """ Remove all vertices of the layer from the index and stop watching it """
+        if layer not in self.features:
+            return
+        self._clear_layer(layer)
+        del self.features[layer]
+        del self.rects[layer]
+
+        layer.geometryChanged.disconnect(self.on_geometry_changed)
+        layer.featureAdded.disconnect(self.on_feature_added)
+        layer.featureDeleted.disconnect(self.on_feature_deleted)
+        layer.editingStopped.disconnect(self.on_editing_stopped)
+        layer.dataChanged.disconnect(self.on_data_changed)
+
+    def clear(self):
+        for layer in self.features.keys():
+            self.drop_layer(layer)
+
+    def _add_feature(self, layer, fid, geom):
+        xs, ys = vertex_coordinates(geom)
+        keys = zip(list(xs), list(ys))
+        for vertex_index, key in enumerate(keys):
+            vertices = self.nodes.get(key)
+            if vertices is None:
+                vertices = self.nodes[key] = set()
+            vertices.add((layer, fid, vertex_index))
+        self.features[layer][fid] = keys
+
+    def _remove_feature(self, layer, fid):
+        keys = self.features[layer].pop(fid, None)
+        if keys is None:
+            return
+        for vertex_index, key in enumerate(keys):
+            vertices = self.nodes[key]
+            vertices.discard((layer, fid, vertex_index))
+            if len(vertices) == 0:
+                del self.nodes[key]
+
+    def _update_dirty(self, layer):
+        """ Re-index all dirty features of the layer (deleted features are just removed) """
+        fids = self.dirty.pop(layer)
+        for fid in fids:
+            self._remove_feature(layer, fid)
+        request = QgsFeatureRequest().setFilterFids(fids).setSubsetOfAttributes([])
+        for f in self.request_stats.get_features(layer, request):
+            self._add_feature(layer, f.id(), f.geometry())
+            self.cache.add(layer, f.id(), f.geometry())
+
+    def on_geometry_changed(self, fid, geom):
+        self.dirty.setdefault(self.sender(), set()).add(fid)
+
+    def on_feature_added(self, fid):
+        self.dirty.setdefault(self.sender(), set()).add(fid)
+
+    def on_feature_deleted(self, fid):
+        self.dirty.setdefault(self.sender(), set()).add(fid)
+
+    def on_editing_stopped(self):
+        self.drop_layer(self.sender())
+
+    def on_data_changed(self):
+        # the layer has been reloaded - index it again when needed
+        self.drop_layer(self.sender())
+
+    def on_layers_will_be_removed(self, layer_ids):
+        for layer in self.features.keys():
+            if layer.id() in layer_ids:
+                self.drop_layer(layer)
@@ -0,0 +1,108 @@
+#-----------------------------------------------------------
+# Copyright (C) 2015 Martin Dobias
+#-----------------------------------------------------------
+# Licensed under the terms of GNU GPL 2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#---------------------------------------------------------------------
+
+from PyQt4.QtCore import *
+
+from qgis.core import *
+
+from geomutils import polygon_from_arrays, arrays_from_polygon
+
+
+class TransformService(QObject):
+    """ Conversions of coordinates between layers and the map canvas.
+    One coordinate transform is kept for each pair of (layer CRS, destination CRS)
+    and it is resolved for a layer just once. Whole arrays of coordinates can be transformed
+    in one call - if no reprojection is needed, they are returned untouched.
+    Everything is invalidated when the map CRS, a layer's CRS or the project changes. """
+
+    def __init__(self, canvas, parent=None):
+        QObject.__init__(self, parent)
+        self.canvas = canvas
+        self.transforms = {}         # { (source CRS srsid, destination CRS srsid) : QgsCoordinateTransform }
+        self.layer_transforms = {}   # { layer : QgsCoordinateTransform or None if there is no reprojection }
+
+        canvas.destinationCrsChanged.connect(self.invalidate)
+        canvas.hasCrsTransformEnabledChanged.connect(self.invalidate)
+        QgsProject.instance().readProject.connect(self.invalidate)
+        QgsMapLayerRegistry.instance().layersWillBeRemoved.connect(self.on_layers_will_be_removed)
+
+    def invalidate(self, *args):
+        for layer in self.layer_transforms.keys():
+            self._forget_layer(layer)
+        self.transforms = {}
+
+    def layer_transform(self, layer):
+        """ Return transform from layer CRS to map CRS (or None if coordinates are the same) """
+        if layer in self.layer_transforms:
+            return self.layer_transforms[layer]
+
+        map_settings = self.canvas.mapSettings()
+        dest_crs = map_settings.destinationCrs()
+        transform = None
+        if map_settings.hasCrsTransformEnabled() and layer.crs() != dest_crs:
+            key = (layer.crs().srsid(), dest_crs.srsid())
+            transform = self.transforms.get(key)
+            if transform is None:
+                transform = QgsCoordinateTransform(layer.crs(), dest_crs)
+                self.transforms[key] = transform
+
+        self.layer_transforms[layer] = transform
+        layer.layerCrsChanged.connect(self.invalidate)
+        return transform
+
+    def to_map_point(self, layer, pt):
+        """ Transform QgsPoint from layer coordinates to map coordinates """
+        transform = self.layer_transform(layer)
+        if transform is None:
+            return QgsPoint(pt)
+        return transform.transform(pt)
+
+    def to_layer_point(self, layer, pt):
+        """ Transform QgsPoint from map coordinates to layer coordinates """
+        transform = self.layer_transform(layer)
+        if transform is None:
+            return QgsPoint(pt)
+        return transform.transform(pt, QgsCoordinateTransform.ReverseTransform)
+
+    def to_layer_rect(self, layer, rect):
+        """ Transform QgsRectangle from map coordinates to layer coordinates """
+        transform = self.layer_transform(layer)
+        if transform is None:
+            return QgsRectangle(rect)
+        return transform.transformBoundingBox(rect, QgsCoordinateTransform.ReverseTransform)
+
+    def to_map_arrays(self, layer, xs, ys):
+        """ Transform arrays of layer coordinates to map coordinates. Returns tuple (xs, ys) """
+        return self._transform_arrays(self.layer_transform(layer), xs, ys, QgsCoordinateTransform.ForwardTransform)
+
+    def to_layer_arrays(self, layer, xs, ys):
+        """ Transform arrays of map coordinates to layer coordinates. Returns tuple (xs, ys) """
+        return self._transform_arrays(self.layer_transform(layer), xs, ys, QgsCoordinateTransform.ReverseTransform)
+
+    def _transform_arrays(self, transform, xs, ys, direction):
+        if transform is None:
+            return xs, ys
+        # all points are passed to proj in one call
+        polygon = polygon_from_arrays(xs, ys)
+        transform.transformPolygon(polygon, direction)
+        return arrays_from_polygon(polygon)
+
+    def _forget_layer(self, layer):
+        del self.layer_transforms[layer]
+        try:
+            layer.layerCrsChanged.disconnect(self.invalidate)
+        except (RuntimeError, TypeError):
+            pass   # the layer has been deleted in the meanwhile
+
+    def on_layers_will_be_removed(self, layer_ids):
+        for layer in self.layer_transforms.keys():
+            if layer.id() in layer_ids:
+                self._forget_layer(layer)
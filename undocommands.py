@@ -0,0 +1,121 @@
+#-----------------------------------------------------------
+# Copyright (C) 2015 Martin Dobias
+#-----------------------------------------------------------
+# Licensed under the terms of GNU GPL 2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#---------------------------------------------------------------------
+
+from PyQt4.QtGui import *
+
+from qgis.core import *
+
+
+# kinds of vertex changes
+MOVE, INSERT, DELETE = range(3)
+
+# id() of QgsVectorLayerUndoCommandChangeGeometry - QUndoStack only merges commands with the same id
+CHANGE_GEOMETRY_COMMAND_ID = 1
+
+
+def records_undo(layer):
+    """ Find out whether edits of the layer go to its undo stack (not with a transaction,
+    where edits are passed straight to the provider) """
+    return layer.editBuffer().metaObject().className() != "QgsVectorLayerEditPassthrough"
+
+
+class VertexDeltaCommand(QUndoCommand):
+    """ Undo command of the node tool that stores just the vertex changes of features instead of
+    whole geometries before and after the edit. A change is one of tuples
+    (MOVE, part, ring, vertex, old x, old y, new x, new y), (INSERT, part, ring, vertex, x, y) or
+    (DELETE, part, ring, vertex, x, y) - in layer coordinates.
+
+    The command is pushed within the layer's edit command and then the geometries are changed
+    with layer.changeGeometry() (so capabilities are checked and the extent is updated as usual).
+    The layer's commands are merged into this command right away and deleted - together with
+    the whole geometries they keep. Undo and redo replay the changes on the current geometries
+    read from the layer. Features that were not changed before the command get back to the
+    unchanged state on undo (they are not in the edit buffer's changed geometries anymore). """
+
+    def __init__(self, layer):
+        QUndoCommand.__init__(self)
+        self.layer = layer
+        self.changes = {}        # { fid : list of vertex changes }
+        self.originals = {}      # { fid : layer's command created before the first change - its undo() restores the feature }
+        self.changed_fids = None # fids of features changed in the edit buffer before this command
+        self.absorbing = False   # whether the layer's command being pushed is to be merged into this command
+        self.absorbed = 0        # number of merged layer's commands
+        self.first_redo = True
+
+    def id(self):
+        return CHANGE_GEOMETRY_COMMAND_ID if self.absorbing else -1
+
+    def mergeWith(self, other):
+        if not self.absorbing:
+            return False
+        self.absorbed += 1
+        return True
+
+    def change_geometry(self, fid, geom, changes):
+        """ Change geometry of the feature with layer.changeGeometry() and keep just the vertex changes for undo.
+        The command must be the last one pushed within the layer's edit command. Returns False on failure """
+        if self.changed_fids is None:
+            self.changed_fids = set(self.layer.editBuffer().changedGeometries().iterkeys())
+        original = None
+        if fid >= 0 and fid not in self.changed_fids:
+            # created while the feature is unchanged: without old geometry, its undo() just drops the change
+            original = QgsVectorLayerUndoCommandChangeGeometry(self.layer.editBuffer(), fid, QgsGeometry())
+
+        absorbed = self.absorbed
+        self.absorbing = True
+        try:
+            if not self.layer.changeGeometry(fid, geom):
+                return False
+        finally:
+            self.absorbing = False
+
+        if self.absorbed == absorbed + 1:
+            self.changes[fid] = changes
+            if original is not None:
+                self.originals[fid] = original
+        # otherwise the layer's command has not been merged - it stays next to this one and takes care of undo
+        return True
+
+    def redo(self):
+        if self.first_redo:
+            self.first_redo = False   # the changes are being done by layer.changeGeometry()
+            return
+        self._replay(self.changes.keys(), False)
+
+    def undo(self):
+        for original in self.originals.itervalues():
+            original.undo()
+        self._replay([fid for fid in self.changes if fid not in self.originals], True)
+
+    def _replay(self, fids, backwards):
+        """ Apply (or revert) the changes of the features to their current geometries """
+        if len(fids) != 0:
+            request = QgsFeatureRequest().setFilterFids(fids).setSubsetOfAttributes([])
+            for f in self.layer.getFeatures(request):
+                # a deep copy: the feature's geometry may share data with the edit buffer
+                geom = QgsGeometry(f.geometry().geometry().clone())
+                g = geom.geometry()
+                changes = self.changes[f.id()]
+                for change in (reversed(changes) if backwards else changes):
+                    kind, part, ring, vertex = change[:4]
+                    vid = QgsVertexId(part, ring, vertex, QgsVertexId.SegmentVertex)
+                    if kind == MOVE:
+                        x, y = change[4:6] if backwards else change[6:8]
+                        g.moveVertex(vid, QgsPointV2(x, y))
+                    elif (kind == INSERT) != backwards:
+                        g.insertVertex(vid, QgsPointV2(change[4], change[5]))
+                    else:
+                        g.deleteVertex(vid)
+                # the layer's own command sets the geometry in the edit buffer (and emits the signals).
+                # It is not pushed - pushing to the undo stack from undo() or redo() is not allowed
+                QgsVectorLayerUndoCommandChangeGeometry(self.layer.editBuffer(), f.id(), geom).redo()
+        self.layer.updateExtents()
+        self.layer.triggerRepaint()
@@ -0,0 +1,246 @@
+#-----------------------------------------------------------
+# Copyright (C) 2015 Martin Dobias
+#-----------------------------------------------------------
+# Licensed under the terms of GNU GPL 2
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#---------------------------------------------------------------------
+
+from PyQt4.QtGui import *
+from PyQt4.QtCore import *
+
+from qgis.core import *
+
+from nodetool import Vertex
+
+
+class VertexTableModel(QAbstractTableModel):
+    """ Table of vertices of one feature. Nothing is copied from the geometry: the view asks
+    just for the visible rows and they are read from the coordinate arrays of the tool's
+    geometry cache. Edited coordinates are collected and applied together as one edit. """
+
+    COLUMNS = ["Vertex", "Part", "Ring", "X", "Y"]
+    X_COLUMN, Y_COLUMN = 3, 4
+
+    def __init__(self, tool, parent=None):
+        QAbstractTableModel.__init__(self, parent)
+        self.tool = tool
+        self.layer = None
+        self.fid = None
+        self.row_count = 0
+        self.precision = 3
+        self.pending = {}             # { vertex index : (x, y) } - edited coordinates not applied yet
+        self.apply_scheduled = False  # whether apply_pending() is going to be called from the event loop
+        self.refresh_scheduled = False
+
+    def set_feature(self, layer, fid):
+        """ Show vertices of the given feature (or nothing if layer is None) """
+        if layer is self.layer and fid == self.fid:
+            return
+        self.apply_pending()
+        self.beginResetModel()
+        if self.layer is not None:
+            self.layer.geometryChanged.disconnect(self.on_geometry_changed)
+            self.layer.featureDeleted.disconnect(self.on_feature_deleted)
+            self.layer.editingStopped.disconnect(self.on_editing_stopped)
+        self.layer, self.fid = layer, fid
+        if layer is not None:
+            layer.geometryChanged.connect(self.on_geometry_changed)
+            layer.featureDeleted.connect(self.on_feature_deleted)
+            layer.editingStopped.connect(self.on_editing_stopped)
+            self.precision = 8 if layer.crs().geographicFlag() else 3
+        self.row_count = self._vertex_count()
+        self.endResetModel()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else self.row_count
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.COLUMNS)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return self.COLUMNS[section]
+        return None
+
+    def flags(self, index):
+        flags = Qt.ItemIsEnabled | Qt.ItemIsSelectable
+        if index.column() in (self.X_COLUMN, self.Y_COLUMN):
+            flags |= Qt.ItemIsEditable
+        return flags
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or role not in (Qt.DisplayRole, Qt.EditRole):
+            return None
+        row, column = index.row(), index.column()
+        if column == 0:
+            return row
+        if column < self.X_COLUMN:
+            vertex_tuple = self.tool.cached_vertex_offsets(self.layer, self.fid).to_tuple(row)
+            return vertex_tuple[column - 1] if vertex_tuple is not None else None
+
+        if row in self.pending:
+            x, y = self.pending[row]
+        else:
+            xs, ys = self.tool.cached_vertex_coordinates(self.layer, self.fid)
+            if row >= len(xs):
+                return None
+            x, y = xs[row], ys[row]
+        value = float(x if column == self.X_COLUMN else y)
+        # editing is done as text so that no precision is lost by a spin box
+        return repr(value) if role == Qt.EditRole else "%.*f" % (self.precision, value)
+
+    def setData(self, index, value, role=Qt.EditRole):
+        if role != Qt.EditRole or index.column() not in (self.X_COLUMN, self.Y_COLUMN):
+            return False
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            return False
+        row = index.row()
+        if row in self.pending:
+            x, y = self.pending[row]
+        else:
+            xs, ys = self.tool.cached_vertex_coordinates(self.layer, self.fid)
+            x, y = xs[row], ys[row]
+        if index.column() == self.X_COLUMN:
+            x = value
+        else:
+            y = value
+        self.pending[row] = (float(x), float(y))
+        self.dataChanged.emit(index, index)
+
+        # all cells committed before returning to the event loop are applied as one edit
+        if not self.apply_scheduled:
+            self.apply_scheduled = True
+            QTimer.singleShot(0, self.apply_pending)
+        return True
+
+    def apply_pending(self):
+        self.apply_scheduled = False
+        if len(self.pending) == 0:
+            return
+        moves = [(row, x, y) for row, (x, y) in sorted(self.pending.iteritems())]
+        self.pending = {}
+        self.tool.move_vertices_to(self.layer, self.fid, moves)
+
+    def refresh(self):
+        """ Update the view after the geometry has changed - only visible rows get read again """
+        self.refresh_scheduled = False
+        if self.layer is None:
+            return
+        row_count = self._vertex_count()
+        if row_count != self.row_count:
+            self.beginResetModel()
+            self.row_count = row_count
+            self.endResetModel()
+        elif row_count != 0:
+            self.dataChanged.emit(self.index(0, 0), self.index(row_count - 1, len(self.COLUMNS) - 1))
+
+    def _vertex_count(self):
+        if self.layer is None:
+            return 0
+        return self.tool.cached_vertex_offsets(self.layer, self.fid).vertex_count()
+
+    def on_geometry_changed(self, fid, geom):
+        if fid != self.fid or self.refresh_scheduled:
+            return
+        # the cache gets the new geometry right after this signal - do not fetch it now
+        self.refresh_scheduled = True
+        QTimer.singleShot(0, self.refresh)
+
+    def on_feature_deleted(self, fid):
+        if fid == self.fid:
+            self.pending = {}
+            self.set_feature(None, None)
+
+    def on_editing_stopped(self):
+        self.pending = {}
+        self.set_feature(None, None)
+
+
+class VertexTableDockWidget(QDockWidget):
+    """ Dock widget with coordinates of vertices of the feature with selected nodes.
+    Selection of rows and selection of nodes in the node tool are kept in sync. """
+
+    def __init__(self, tool, parent=None):
+        QDockWidget.__init__(self, "Node Tool Vertices", parent)
+        self.setObjectName("CadNodeToolVertexDock")
+        self.tool = tool
+        self.syncing = False   # whether selection is being changed by us (to avoid loops)
+
+        self.model = VertexTableModel(tool, self)
+        self.view = QTableView()
+        self.view.setModel(self.model)
+        self.view.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.view.setEditTriggers(QAbstractItemView.DoubleClicked | QAbstractItemView.EditKeyPressed)
+        self.view.verticalHeader().setVisible(False)
+        # fixed row height - the view never needs to measure rows outside of the viewport
+        self.view.verticalHeader().setResizeMode(QHeaderView.Fixed)
+        self.view.verticalHeader().setDefaultSectionSize(self.view.fontMetrics().height() + 6)
+        self.view.horizontalHeader().setStretchLastSection(True)
+        self.view.selectionModel().selectionChanged.connect(self.on_view_selection_changed)
+        self.setWidget(self.view)
+
+        # selection of nodes may be changing quickly (e.g. chunks from background selection)
+        self.sync_timer = QTimer(self)
+        self.sync_timer.setSingleShot(True)
+        self.sync_timer.setInterval(100)
+        self.sync_timer.timeout.connect(self.sync_from_tool)
+        self.tool.highlighted_nodes_changed.connect(self.on_highlighted_nodes_changed)
+        self.visibilityChanged.connect(self.on_visibility_changed)
+
+    def on_visibility_changed(self, visible):
+        if visible:
+            self.sync_from_tool()
+
+    def on_highlighted_nodes_changed(self):
+        if not self.syncing and self.isVisible():
+            self.sync_timer.start()
+
+    def sync_from_tool(self):
+        """ Show feature of the selected nodes and select their rows """
+        self.sync_timer.stop()
+        nodes = self.tool.selected_nodes
+        if len(nodes) == 0:
+            self._select_rows([])
+            return
+        layer, fid = nodes[0].layer, nodes[0].fid
+        self.model.set_feature(layer, fid)
+        rows = [node.vertex_id for node in nodes
+                if node.layer is layer and node.fid == fid and 0 <= node.vertex_id < self.model.row_count]
+        self._select_rows(rows)
+        if len(rows) != 0:
+            self.view.scrollTo(self.model.index(min(rows), 0))
+
+    def on_view_selection_changed(self, selected, deselected):
+        if self.syncing or self.model.layer is None:
+            return
+        layer, fid = self.model.layer, self.model.fid
+        rows = sorted(set(index.row() for index in self.view.selectionModel().selectedRows()))
+        self.syncing = True
+        try:
+            self.tool.set_highlighted_nodes([Vertex(layer, fid, row) for row in rows])
+        finally:
+            self.syncing = False
+
+    def _select_rows(self, rows):
+        """ Select rows - consecutive rows are selected as one range """
+        selection = QItemSelection()
+        last_column = len(self.model.COLUMNS) - 1
+        rows = sorted(set(rows))
+        i = 0
+        while i < len(rows):
+            j = i
+            while j + 1 < len(rows) and rows[j + 1] == rows[j] + 1:
+                j += 1
+            selection.select(self.model.index(rows[i], 0), self.model.index(rows[j], last_column))
+            i = j + 1
+        self.syncing = True
+        try:
+            self.view.selectionModel().select(selection, QItemSelectionModel.ClearAndSelect)
+        finally:
+            self.syncing = False